@@ -3,12 +3,17 @@ from collections import defaultdict
 from typing import Dict, Any, Optional, List, Tuple, Iterator, AsyncIterator, Union
 
 from langchain_aws import ChatBedrock
+from langchain_core.caches import BaseCache
 from langchain_core.callbacks import CallbackManagerForLLMRun, AsyncCallbackManagerForLLMRun
-from langchain_core.language_models import LanguageModelInput
-from langchain_core.messages import ToolCall, AIMessageChunk, BaseMessage
-from langchain_core.outputs import GenerationChunk
+from langchain_core.load import dumps
+from langchain_core.messages import ToolCall, AIMessageChunk, BaseMessage, message_chunk_to_message
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, GenerationChunk
 from langchain_core.pydantic_v1 import Field
-from langchain_core.runnables import RunnableConfig
+
+from src.static.metrics import LLM_COST, LLM_LATENCY, LLM_TOKENS
+from src.static.rate_limiter import (
+    INTERACTIVE, astream_with_retries, call_with_retries, get_rate_limiter, stream_with_retries
+)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -48,23 +53,47 @@ class ChatBedrockWrapper(ChatBedrock):
     call_id: str = Field(exclude=False)
     model_name: str = Field(exclude=False, default='AWS_Bedrock')
     model_id: str = Field(exclude=False)
+    # calls of lower priority wait in the shared rate limiter queue, see rate_limiter.py
+    priority: int = Field(exclude=False, default=INTERACTIVE)
 
+    def _get_llm_string(self, stop: Optional[List[str]] = None, **kwargs: Any) -> str:
+        # call_id and priority differ between requests, but must not prevent sharing cached responses
+        params = {'model_id': self.model_id, 'model_kwargs': self.model_kwargs, 'stop': stop, **kwargs}
+        return str(sorted(params.items()))
 
-    def invoke(
+    def _stream(
             self,
-            input: LanguageModelInput,
-            config: Optional[RunnableConfig] = None,
-            *,
+            messages: List[BaseMessage],
             stop: Optional[List[str]] = None,
+            run_manager: Optional[CallbackManagerForLLMRun] = None,
             **kwargs: Any,
-    ) -> BaseMessage:
-        messages = map(lambda m: m.content, self._convert_input(input).to_messages())
-        messages = [{'content': message} for message in messages]
-        self._update_token_counter_prompt(None, None, messages)
-        ret = super().invoke(input, config, stop=stop, **kwargs)
-        content = ret.content if isinstance(ret.content, str) else ''
-        self._update_token_counter_completion(content)
-        return ret
+    ) -> Iterator[ChatGenerationChunk]:
+        # BaseChatModel.stream skips the cache, yet the crew agents stream their calls
+        if not isinstance(self.cache, BaseCache):
+            yield from super()._stream(messages, stop, run_manager, **kwargs)
+            return
+        prompt = dumps(messages)
+        llm_string = self._get_llm_string(stop=stop, **kwargs)
+        cached = self.cache.lookup(prompt, llm_string)
+        if cached:
+            for generation in cached:
+                chunk = ChatGenerationChunk(
+                    message=AIMessageChunk(content=generation.message.content),
+                    generation_info=generation.generation_info
+                )
+                if run_manager:
+                    run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+            return
+        generation = None
+        for chunk in super()._stream(messages, stop, run_manager, **kwargs):
+            generation = chunk if generation is None else generation + chunk
+            yield chunk
+        # only complete responses are cached
+        if generation is not None:
+            self.cache.update(prompt, llm_string, [
+                ChatGeneration(message=message_chunk_to_message(generation.message), generation_info=generation.generation_info)
+            ])
 
     def _prepare_input_and_invoke(
             self,
@@ -75,16 +104,24 @@ class ChatBedrockWrapper(ChatBedrock):
             run_manager: Optional[CallbackManagerForLLMRun] = None,
             **kwargs: Any,
     ) -> Tuple[str, List[ToolCall], Dict[str, Any]]:
-        self._update_token_counter_prompt(prompt, system, messages)
-        text, tool_calls, metadata = super()._prepare_input_and_invoke(prompt, system, messages, stop, run_manager, **kwargs)
-        self._update_token_counter_completion(text)
+        # tokens are counted only here and in the stream paths, the calls which reach Bedrock, never on cache hits
+        tokens = self._update_token_counter_prompt(prompt, system, messages)
+        invoke = super()._prepare_input_and_invoke
+
+        def timed_invoke():
+            with LLM_LATENCY.time(model_id=self.model_id):
+                return invoke(prompt, system, messages, stop, run_manager, **kwargs)
+
+        text, tool_calls, metadata = call_with_retries(self.model_id, tokens, timed_invoke, priority=self.priority)
+        get_rate_limiter(self.model_id).record_tokens(self._update_token_counter_completion(text))
         return text, tool_calls, metadata
 
-    def __process_chunk_content(self, chunk: Union[GenerationChunk, AIMessageChunk]):
+    def __process_chunk_content(self, chunk: Union[GenerationChunk, AIMessageChunk]) -> int:
         if isinstance(chunk, GenerationChunk):
-            self._update_token_counter_completion(chunk.text)
+            return self._update_token_counter_completion(chunk.text)
         elif isinstance(chunk, AIMessageChunk):
-            self._update_token_counter_completion(chunk.content)
+            return self._update_token_counter_completion(chunk.content)
+        return 0
 
     def _prepare_input_and_invoke_stream(
             self,
@@ -95,12 +132,22 @@ class ChatBedrockWrapper(ChatBedrock):
             run_manager: Optional[CallbackManagerForLLMRun] = None,
             **kwargs: Any,
     ) -> Iterator[Union[GenerationChunk, AIMessageChunk]]:
-        self._update_token_counter_prompt(prompt, system, messages)
-        stream = super()._prepare_input_and_invoke_stream(prompt, system, messages, stop, run_manager, **kwargs)
+        tokens = self._update_token_counter_prompt(prompt, system, messages)
+        invoke_stream = super()._prepare_input_and_invoke_stream
+
+        def timed_stream() -> Iterator[Union[GenerationChunk, AIMessageChunk]]:
+            # the request is sent on the first next(), the timer stops after the last chunk
+            with LLM_LATENCY.time(model_id=self.model_id):
+                yield from invoke_stream(prompt, system, messages, stop, run_manager, **kwargs)
+
         def inner() -> Iterator[Union[GenerationChunk, AIMessageChunk]]:
-            for chunk in stream:
-                self.__process_chunk_content(chunk)
-                yield chunk
+            completion_tokens = 0
+            try:
+                for chunk in stream_with_retries(self.model_id, tokens, timed_stream, priority=self.priority):
+                    completion_tokens += self.__process_chunk_content(chunk)
+                    yield chunk
+            finally:
+                get_rate_limiter(self.model_id).record_tokens(completion_tokens)
         return inner()
 
     async def _aprepare_input_and_invoke_stream(
@@ -110,13 +157,22 @@ class ChatBedrockWrapper(ChatBedrock):
             run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
             **kwargs: Any,
     ) -> AsyncIterator[GenerationChunk]:
-        self._update_token_counter_prompt(prompt, None, None)
-        stream = super()._aprepare_input_and_invoke_stream(prompt, stop, run_manager, **kwargs)
+        tokens = self._update_token_counter_prompt(prompt, None, None)
+        invoke_stream = super()._aprepare_input_and_invoke_stream
+
+        async def timed_stream() -> AsyncIterator[GenerationChunk]:
+            with LLM_LATENCY.time(model_id=self.model_id):
+                async for chunk in invoke_stream(prompt, stop, run_manager, **kwargs):
+                    yield chunk
 
         async def inner() -> AsyncIterator[GenerationChunk]:
-            async for chunk in stream:
-                self._update_token_counter_completion(chunk.text)
-                yield chunk
+            completion_tokens = 0
+            try:
+                async for chunk in astream_with_retries(self.model_id, tokens, timed_stream, priority=self.priority):
+                    completion_tokens += self._update_token_counter_completion(chunk.text)
+                    yield chunk
+            finally:
+                get_rate_limiter(self.model_id).record_tokens(completion_tokens)
 
         return inner()
 
@@ -138,11 +194,15 @@ class ChatBedrockWrapper(ChatBedrock):
         TOKEN_COUNTER[self.call_id][self.model_id]['total_tokens'] += tokens
         TOKEN_COUNTER[self.call_id][self.model_id]['prompt_tokens'] += tokens
         TOKEN_COUNTER[self.call_id][self.model_id]['successful_requests'] += 1
-        TOKEN_COUNTER[self.call_id][self.model_id]['total_cost'] += get_token_cost(
+        cost = get_token_cost(
             tokens=tokens,
             model_id=self.model_id,
             mode='prompt'
         )
+        TOKEN_COUNTER[self.call_id][self.model_id]['total_cost'] += cost
+        LLM_TOKENS.inc(tokens, model_id=self.model_id, type='prompt')
+        LLM_COST.inc(cost, model_id=self.model_id)
+        return tokens
 
     def _update_token_counter_completion(self, text):
         tokens = self.get_num_tokens(text)
@@ -150,24 +210,32 @@ class ChatBedrockWrapper(ChatBedrock):
             TOKEN_COUNTER[self.call_id][self.model_id] = _empty_metrics()
         TOKEN_COUNTER[self.call_id][self.model_id]['total_tokens'] += tokens
         TOKEN_COUNTER[self.call_id][self.model_id]['completion_tokens'] += tokens
-        TOKEN_COUNTER[self.call_id][self.model_id]['total_cost'] += get_token_cost(
+        cost = get_token_cost(
             tokens=tokens,
             model_id=self.model_id,
             mode='completion'
         )
+        TOKEN_COUNTER[self.call_id][self.model_id]['total_cost'] += cost
+        LLM_TOKENS.inc(tokens, model_id=self.model_id, type='completion')
+        LLM_COST.inc(cost, model_id=self.model_id)
+        return tokens
+
+
+# Cost in USD per 1,000 input and output tokens of the models whose tokens can be counted
+TOKEN_COSTS = {
+    'anthropic.claude-3-5-sonnet-20240620-v1:0': {'input': 0.003, 'output': 0.015},
+    'anthropic.claude-3-haiku-20240307-v1:0': {'input': 0.00025, 'output': 0.00125},
+    'amazon.titan-text-premier-v1:0': {'input': 0.0005, 'output': 0.0015},
+    'meta.llama3-8b-instruct-v1:0': {'input': 0.0003, 'output': 0.0006},
+    'meta.llama3-70b-instruct-v1:0': {'input': 0.00265, 'output': 0.0035},
+    'mistral.mistral-7b-instruct-v0:2': {'input': 0.00015, 'output': 0.0002},
+    'mistral.mixtral-8x7b-instruct-v0:1': {'input': 0.00045, 'output': 0.0007}
+}
 
 
 def get_token_cost(tokens: int, model_id: str, mode: str) -> float:
     assert mode in ['prompt', 'completion', 'input', 'output'], f'mode "{mode}" is not supported'
-    cost_mapping = {
-        'anthropic.claude-3-5-sonnet-20240620-v1:0': {'input': 0.003, 'output': 0.015},
-        'anthropic.claude-3-haiku-20240307-v1:0': {'input': 0.00025, 'output': 0.00125},
-        'amazon.titan-text-premier-v1:0': {'input': 0.0005, 'output': 0.0015},
-        'meta.llama3-8b-instruct-v1:0': {'input': 0.0003, 'output': 0.0006},
-        'meta.llama3-70b-instruct-v1:0': {'input': 0.00265, 'output': 0.0035},
-        'mistral.mistral-7b-instruct-v0:2': {'input': 0.00015, 'output': 0.0002},
-        'mistral.mixtral-8x7b-instruct-v0:1': {'input': 0.00045, 'output': 0.0007}
-    }
+    cost_mapping = TOKEN_COSTS
     if mode == 'prompt':
         mode = 'input'
     elif mode == 'completion':
@@ -1,16 +1,22 @@
 import asyncio
 import datetime as dt
+import json
 import random
 import dotenv
 import uvicorn
 
 from async_timeout import timeout
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
 
 from src.submission.create_submission import create_submission
 from src.static.ChatBedrockWrapper import TOKEN_COUNTER, get_total_number_of_tokens, get_total_cost, get_token_details
+from src.submission.routing import ROUTE_COUNTER, get_route_details
+from src.submission.extractors import AVOIDED_LLM_CALLS, get_avoided_llm_calls
+from src.static.metrics import REQUEST_LATENCY, REQUEST_TIMEOUTS, render_metrics
+from src.static.rate_limiter import get_rate_limiter_metrics
+from src.submission.batch import DEFAULT_PARALLELISM, run_batch
 
 dotenv.load_dotenv()
 
@@ -20,6 +26,12 @@ class Payload(BaseModel):
     timeout: int = 7*60  # 7 minutes
 
 
+class BatchPayload(BaseModel):
+    prompts: list[str] = Field(min_length=1)
+    parallelism: int = Field(DEFAULT_PARALLELISM, gt=0)
+    timeout: int = Field(7*60, gt=0)  # 7 minutes per prompt
+
+
 app = FastAPI()
 
 
@@ -28,10 +40,23 @@ async def health_check():
     return {"message": "Server is running. You may direct queries to api"}
 
 
+@app.get("/rate_limiter")
+async def rate_limiter_metrics():
+    return get_rate_limiter_metrics()
+
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type='text/plain; version=0.0.4')
+
+
 @app.post("/run")
 async def run_task(payload: Payload):
+    request_start_time = asyncio.get_event_loop().time()
     call_id = dt.datetime.now().strftime("%Y%m%d%H%M%S%f") + f'_{random.randint(0, 1_000_000)}'
     TOKEN_COUNTER[call_id] = {}
+    ROUTE_COUNTER[call_id] = {}
+    AVOIDED_LLM_CALLS[call_id] = {}
     try:
         submission = create_submission(call_id=call_id)
 
@@ -52,23 +77,45 @@ async def run_task(payload: Payload):
             "timed_out": False,
             'tokens': get_total_number_of_tokens(call_id),
             'cost': get_total_cost(call_id),
-            'token_details': get_token_details(call_id)
+            'token_details': get_token_details(call_id),
+            'route_details': get_route_details(call_id),
+            'avoided_llm_calls': get_avoided_llm_calls(call_id)
         })
 
     except asyncio.TimeoutError as e:
+        REQUEST_TIMEOUTS.inc(endpoint='/run')
         return JSONResponse(content={
             "result": None,
             "time": None,
             "timed_out": True,
             'tokens': get_total_number_of_tokens(call_id),
             'cost': get_total_cost(call_id),
-            'token_details': get_token_details(call_id)
+            'token_details': get_token_details(call_id),
+            'route_details': get_route_details(call_id),
+            'avoided_llm_calls': get_avoided_llm_calls(call_id)
         })
     except Exception as e:
         print(e)
         raise HTTPException(status_code=500, detail=str(e))
     finally:
+        REQUEST_LATENCY.observe(asyncio.get_event_loop().time() - request_start_time, endpoint='/run')
         del TOKEN_COUNTER[call_id]
+        ROUTE_COUNTER.pop(call_id, None)
+        AVOIDED_LLM_CALLS.pop(call_id, None)
+
+
+@app.post("/run_batch")
+async def run_batch_task(payload: BatchPayload):
+    async def results():
+        # the response has already started, so errors are reported as the last record instead of a status code
+        try:
+            async for result in run_batch(payload.prompts, payload.parallelism, payload.timeout):
+                yield json.dumps(result) + '\n'
+        except Exception as e:
+            print(e)
+            yield json.dumps({'error': str(e)}) + '\n'
+
+    return StreamingResponse(results(), media_type='application/x-ndjson')
 
 
 if __name__ == '__main__':
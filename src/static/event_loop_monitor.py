@@ -0,0 +1,100 @@
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from typing import Any, Optional
+
+PROJECT_MARKER = f'{__package__.split(".")[0]}/'
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[round(q / 100 * (len(values) - 1))]
+
+
+class EventLoopLagMonitor:
+    """Measures how late the event loop wakes up and flags code paths blocking it.
+
+    A heartbeat task sleeps for `interval` and records how much later than requested it woke up. A watchdog
+    thread captures the stack of the event loop thread whenever the heartbeat has been silent for longer than
+    `threshold` seconds, so every blocking period is reported together with the code that caused it.
+    """
+
+    def __init__(self, threshold: float = 0.1, interval: float = 0.01):
+        self.threshold = threshold
+        self.interval = interval
+        self.lags: list[float] = []
+        self.events: list[dict[str, Any]] = []
+
+        self.__loop_thread_id: Optional[int] = None
+        self.__last_beat = time.monotonic()
+        self.__pending_stack: Optional[list[str]] = None
+        self.__running = False
+        self.__task: Optional[asyncio.Task] = None
+        self.__watchdog: Optional[threading.Thread] = None
+
+    async def __heartbeat(self):
+        while self.__running:
+            before = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.__last_beat = time.monotonic()
+            lag = max(0.0, self.__last_beat - before - self.interval)
+            self.lags.append(lag)
+            if lag > self.threshold:
+                self.events.append({'lag': lag, 'stack': self.__pending_stack or []})
+            self.__pending_stack = None
+
+    def __watch(self):
+        while self.__running:
+            time.sleep(self.threshold / 2)
+            if self.__pending_stack is None and time.monotonic() - self.__last_beat > self.threshold:
+                frame = sys._current_frames().get(self.__loop_thread_id)
+                if frame is not None:
+                    self.__pending_stack = traceback.format_stack(frame)
+
+    def start(self):
+        """Starts monitoring the running event loop. Must be called from a coroutine."""
+        self.__loop_thread_id = threading.get_ident()
+        self.__last_beat = time.monotonic()
+        self.__running = True
+        self.__task = asyncio.get_running_loop().create_task(self.__heartbeat())
+        self.__watchdog = threading.Thread(target=self.__watch, daemon=True)
+        self.__watchdog.start()
+
+    async def stop(self):
+        self.__running = False
+        if self.__task is not None:
+            await self.__task
+        if self.__watchdog is not None:
+            self.__watchdog.join()
+
+    @staticmethod
+    def blocking_location(stack: list[str]) -> str:
+        # innermost frame of the project code, or the innermost frame at all
+        for frame in reversed(stack):
+            if PROJECT_MARKER in frame and 'event_loop_monitor' not in frame:
+                return frame.strip().splitlines()[0]
+        return stack[-1].strip().splitlines()[0] if stack else 'unknown'
+
+    def report(self) -> dict[str, Any]:
+        locations = Counter()
+        max_lag_per_location: dict[str, float] = {}
+        for event in self.events:
+            location = self.blocking_location(event['stack'])
+            locations[location] += 1
+            max_lag_per_location[location] = max(max_lag_per_location.get(location, 0.0), event['lag'])
+        return {
+            'threshold': self.threshold,
+            'lag_p50': percentile(self.lags, 50),
+            'lag_p99': percentile(self.lags, 99),
+            'lag_max': max(self.lags, default=0.0),
+            'blocking_events': len(self.events),
+            'blocking_locations': [
+                {'location': location, 'count': count, 'max_lag': max_lag_per_location[location]}
+                for location, count in locations.most_common()
+            ]
+        }
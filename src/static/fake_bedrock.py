@@ -0,0 +1,189 @@
+"""Local stand-in for the Bedrock runtime API which simulates throttling.
+
+Both InvokeModel and InvokeModelWithResponseStream are served, the latter in the AWS event stream framing
+botocore decodes, so chains as well as the streaming crew agents can be sent to it. Start it with `python -m src.static.fake_bedrock --port 8001 --requests-per-minute 30` and point the models to it
+with `BEDROCK_ENDPOINT_URL=http://localhost:8001` (any AWS credentials will do).
+"""
+import argparse
+import base64
+import json
+import re
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import unquote
+
+DEFAULT_REPLY = 'Thought: I now know the final answer\nFinal Answer: This is a fake answer.'
+INVOKE_PATH = re.compile(r'^/model/(?P<model_id>[^/]+)/(?P<action>invoke|invoke-with-response-stream)$')
+EVENT_STREAM_HEADERS = [(':event-type', 'chunk'), (':content-type', 'application/json'), (':message-type', 'event')]
+STRING_HEADER_TYPE = 7
+
+
+def encode_event(payload: dict) -> bytes:
+    """Frames `payload` as a `chunk` event of the AWS event stream, the way Bedrock streams model output."""
+    headers = b''
+    for name, value in EVENT_STREAM_HEADERS:
+        headers += struct.pack('>B', len(name)) + name.encode()
+        headers += struct.pack('>BH', STRING_HEADER_TYPE, len(value)) + value.encode()
+    body = json.dumps({'bytes': base64.b64encode(json.dumps(payload).encode()).decode()}).encode()
+    # prelude: total length, headers length and their crc, then the message is closed by the crc of all of it
+    prelude = struct.pack('>II', 12 + len(headers) + len(body) + 4, len(headers))
+    message = prelude + struct.pack('>I', zlib.crc32(prelude)) + headers + body
+    return message + struct.pack('>I', zlib.crc32(message))
+
+
+def _message_events(message_id: str, model_id: str, reply: str, prompt_tokens: int) -> list[dict]:
+    # events of the Anthropic messages API, the reply streamed word by word
+    words = reply.split(' ')
+    return [
+        {'type': 'message_start', 'message': {
+            'id': message_id, 'type': 'message', 'role': 'assistant', 'model': model_id, 'content': [],
+            'stop_reason': None, 'stop_sequence': None, 'usage': {'input_tokens': prompt_tokens, 'output_tokens': 1}
+        }},
+        {'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}},
+        *[
+            {'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': word if i == 0 else ' ' + word}}
+            for i, word in enumerate(words)
+        ],
+        {'type': 'content_block_stop', 'index': 0},
+        {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None}, 'usage': {'output_tokens': len(words)}},
+        {'type': 'message_stop', 'amazon-bedrock-invocationMetrics': {
+            'inputTokenCount': prompt_tokens, 'outputTokenCount': len(words), 'invocationLatency': 0, 'firstByteLatency': 0
+        }}
+    ]
+
+
+class ThrottlingBucket:
+    """Allows `requests_per_minute` calls per minute, like the on-demand quota of a Bedrock model.
+
+    Up to `burst` calls, by default a whole minute of them, may be sent at once.
+    """
+
+    def __init__(self, requests_per_minute: float, burst: Optional[float] = None):
+        self.requests_per_minute = requests_per_minute
+        self.burst = burst or requests_per_minute
+        self.__available = float(self.burst)
+        self.__refilled_at = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def try_take(self) -> bool:
+        with self.__lock:
+            now = time.monotonic()
+            self.__available = min(
+                self.burst,
+                self.__available + (now - self.__refilled_at) * self.requests_per_minute / 60
+            )
+            self.__refilled_at = now
+            if self.__available < 1:
+                return False
+            self.__available -= 1
+            return True
+
+
+def make_handler(bucket: ThrottlingBucket, latency: float, reply: str, stats: dict):
+    stats_lock = threading.Lock()
+
+    class FakeBedrockHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def __send_json(self, status: int, body: dict, headers: Optional[dict] = None):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def __send_events(self, events: list[dict]):
+            data = b''.join(encode_event(event) for event in events)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/vnd.amazon.eventstream')
+            self.send_header('x-amzn-bedrock-content-type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            match = INVOKE_PATH.match(self.path)
+            if match is None:
+                self.__send_json(404, {'message': f'Unsupported path {self.path}'})
+                return
+            if not bucket.try_take():
+                with stats_lock:
+                    stats['throttled'] += 1
+                self.__send_json(
+                    429,
+                    {'message': 'Too many requests, please wait before trying again.'},
+                    {'x-amzn-ErrorType': 'ThrottlingException:http://internal.amazon.com/coral/com.amazon.bedrock/'}
+                )
+                return
+            with stats_lock:
+                stats['served'] += 1
+                served = stats['served']
+            time.sleep(latency)
+            model_id = unquote(match.group('model_id'))
+            streaming = match.group('action') == 'invoke-with-response-stream'
+            if 'messages' in body:
+                prompt_tokens = sum(len(str(m.get('content', '')).split()) for m in body['messages'])
+                if streaming:
+                    self.__send_events(_message_events(f'msg_fake_{served}', model_id, reply, prompt_tokens))
+                    return
+                self.__send_json(200, {
+                    'id': f'msg_fake_{served}',
+                    'type': 'message',
+                    'role': 'assistant',
+                    'model': model_id,
+                    'content': [{'type': 'text', 'text': reply}],
+                    'stop_reason': 'end_turn',
+                    'stop_sequence': None,
+                    'usage': {'input_tokens': prompt_tokens, 'output_tokens': len(reply.split())}
+                })
+            elif streaming:
+                self.__send_events([{'completion': reply, 'stop_reason': 'stop_sequence'}])
+            else:
+                self.__send_json(200, {'completion': reply, 'stop_reason': 'stop_sequence'})
+
+    return FakeBedrockHandler
+
+
+def serve(
+        host: str = 'localhost',
+        port: int = 8001,
+        requests_per_minute: float = 60,
+        latency: float = 0.5,
+        reply: str = DEFAULT_REPLY,
+        burst: Optional[float] = None
+) -> tuple[ThreadingHTTPServer, dict]:
+    """Starts the fake endpoint in a background thread. Returns the server and its served/throttled counters."""
+    stats = {'served': 0, 'throttled': 0}
+    bucket = ThrottlingBucket(requests_per_minute, burst)
+    server = ThreadingHTTPServer((host, port), make_handler(bucket, latency, reply, stats))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Bedrock runtime endpoint simulating throttling')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--requests-per-minute', type=float, default=60)
+    parser.add_argument('--latency', type=float, default=0.5, help='seconds spent on every served call')
+    parser.add_argument('--reply', default=DEFAULT_REPLY)
+    parser.add_argument('--burst', type=float, default=None, help='calls allowed at once, a minute of calls by default')
+    args = parser.parse_args()
+
+    server, stats = serve(args.host, args.port, args.requests_per_minute, args.latency, args.reply, args.burst)
+    print(f'Fake Bedrock listening on http://{args.host}:{args.port}')
+    try:
+        while True:
+            time.sleep(10)
+            print(stats)
+    except KeyboardInterrupt:
+        server.shutdown()
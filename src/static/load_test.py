@@ -0,0 +1,220 @@
+"""Load test of the FastAPI app with fake LLM, database and storage backends.
+
+The app from `src/static/app.py` is driven in-process through its ASGI interface, so the event loop lag
+monitor watches the very loop serving the requests. Requests go through the real `create_submission`, model
+router and rate limiter; only the backends are swapped: models are served by the fake Bedrock endpoint, the
+database is a local SQLite file, the S3 download of the vector database is simulated with a configurable delay
+and the crew is replaced by a fixed number of SQL tool and LLM calls.
+
+Usage example:
+python -m src.static.load_test --requests 200 --concurrency 16 --arrival-rate 4
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import random
+import socket
+import tempfile
+import time
+from typing import Any
+
+from src.static.event_loop_monitor import EventLoopLagMonitor, percentile
+
+FAKE_TABLE_ROWS = 60
+FAKE_DOCUMENT = 'PIRLS 2021 assessed the reading literacy of fourth grade students in 57 countries.'
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def _prepare_fake_environment(args: argparse.Namespace):
+    # must run before the app is imported, as the database engine and the models are created from it
+    import yaml
+
+    from src.static.fake_bedrock import serve
+    from src.static.rate_limiter import DEFAULT_LIMITS
+
+    # the shared rate limiter gets the quota of the fake endpoint instead of the Bedrock one
+    fake_limits = {
+        'requests_per_minute': args.llm_requests_per_minute,
+        'tokens_per_minute': 1_000_000_000,
+        'max_concurrency': args.llm_max_concurrency
+    }
+    rate_limits_path = os.path.join(tempfile.mkdtemp(), 'rate_limits.yaml')
+    with open(rate_limits_path, 'w') as f:
+        yaml.safe_dump({model_id: fake_limits for model_id in [*DEFAULT_LIMITS, 'default']}, f)
+    os.environ['RATE_LIMITS_PATH'] = rate_limits_path
+    port = _free_port()
+    serve(port=port, requests_per_minute=args.llm_requests_per_minute, latency=args.llm_latency)
+    os.environ['BEDROCK_ENDPOINT_URL'] = f'http://localhost:{port}'
+    for key, value in {
+        'AWS_ACCESS_KEY_ID': 'fake', 'AWS_SECRET_ACCESS_KEY': 'fake', 'AWS_DEFAULT_REGION': 'us-east-1',
+        'DB_USER': 'fake', 'DB_PASSWORD': 'fake', 'DB_ENDPOINT': 'localhost', 'DB_PORT': '5432'
+    }.items():
+        os.environ.setdefault(key, value)
+
+
+def _create_fake_database() -> Any:
+    import sqlalchemy
+
+    path = os.path.join(tempfile.mkdtemp(), 'fake_pirls.db')
+    engine = sqlalchemy.create_engine(f'sqlite:///{path}')
+    with engine.begin() as connection:
+        connection.execute(sqlalchemy.text('CREATE TABLE Countries (Name TEXT, Score REAL)'))
+        connection.execute(
+            sqlalchemy.text('INSERT INTO Countries VALUES (:name, :score)'),
+            [{'name': f'Country {i}', 'score': random.uniform(350, 600)} for i in range(FAKE_TABLE_ROWS)]
+        )
+    return engine
+
+
+class FakeCollection:
+    """Stands in for the chroma collection, answering every query with the same documents."""
+
+    def query(self, query_texts: list[str], n_results: int) -> dict[str, list]:
+        return {
+            'metadatas': [[{'source': 'https://www.iea.nl/studies/iea/pirls/2021'}] * n_results for _ in query_texts],
+            'documents': [[FAKE_DOCUMENT] * n_results for _ in query_texts]
+        }
+
+
+def _patch_backends(args: argparse.Namespace):
+    import src.submission.tools.database as db_tools
+    from src.submission.crews.advanced_PIRLS_crew_rag_gdp import AdvancedPIRLSCrew
+
+    db_tools.ENGINE = _create_fake_database()
+
+    def get_rag_collection(crew: AdvancedPIRLSCrew) -> FakeCollection:
+        time.sleep(args.storage_latency)
+        return FakeCollection()
+
+    def answer(crew: AdvancedPIRLSCrew, prompt: str, new_prompt: str) -> str:
+        # SQL tool and LLM calls of the crew, sent through the router built by create_submission
+        results = [
+            db_tools.query_database.invoke({'query': 'SELECT Name, Score FROM Countries ORDER BY Score DESC'})
+            for _ in range(args.sql_calls)
+        ]
+        ret = ''
+        for _ in range(args.llm_calls):
+            ret = crew.router.track('crew', None, lambda: crew.llm.invoke(f'{new_prompt}\n{results[-1] if results else ""}').content)
+        return ret
+
+    AdvancedPIRLSCrew.get_rag_collection = get_rag_collection
+    AdvancedPIRLSCrew.answer = answer
+
+
+async def _post(app: Any, path: str, payload: dict) -> tuple[int, dict]:
+    body = json.dumps(payload).encode()
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'POST',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'root_path': '',
+        'query_string': b'',
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+        'client': ('127.0.0.1', 0),
+        'server': ('127.0.0.1', 8000)
+    }
+    request_sent = False
+    response = {'status': 500, 'body': b''}
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+        elif message['type'] == 'http.response.body':
+            response['body'] += message.get('body', b'')
+
+    await app(scope, receive, send)
+    return response['status'], json.loads(response['body'] or b'{}')
+
+
+async def run_load_test(args: argparse.Namespace) -> dict[str, Any]:
+    _prepare_fake_environment(args)
+    import src.static.app as app_module
+
+    _patch_backends(args)
+    if args.executor_threads:
+        asyncio.get_running_loop().set_default_executor(
+            concurrent.futures.ThreadPoolExecutor(max_workers=args.executor_threads)
+        )
+
+    monitor = EventLoopLagMonitor(threshold=args.lag_threshold / 1000)
+    monitor.start()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    results: list[dict[str, Any]] = []
+
+    async def one_request(i: int):
+        arrived_at = time.perf_counter()
+        async with semaphore:
+            try:
+                status, body = await _post(app_module.app, '/run', {'prompt': f'Benchmark question {i}', 'timeout': args.timeout})
+            except Exception as e:
+                status, body = 500, {'detail': str(e)}
+        results.append({
+            'status': status,
+            'timed_out': body.get('timed_out', False),
+            'latency': time.perf_counter() - arrived_at
+        })
+
+    start_time = time.perf_counter()
+    tasks = []
+    for i in range(args.requests):
+        tasks.append(asyncio.create_task(one_request(i)))
+        if args.arrival_rate > 0:
+            # open loop: Poisson arrivals independent of the response times
+            await asyncio.sleep(random.expovariate(args.arrival_rate))
+    await asyncio.gather(*tasks)
+    duration = time.perf_counter() - start_time
+    await monitor.stop()
+
+    succeeded = [r for r in results if r['status'] == 200 and not r['timed_out']]
+    latencies = [r['latency'] for r in succeeded]
+    return {
+        'requests': len(results),
+        'succeeded': len(succeeded),
+        'duration': duration,
+        'throughput': len(succeeded) / duration,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'latency_p99': percentile(latencies, 99),
+        'timeout_rate': sum(r['timed_out'] for r in results) / len(results),
+        'error_rate': sum(r['status'] != 200 for r in results) / len(results),
+        'event_loop': monitor.report()
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Load test of the /run endpoint with fake backends')
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8, help='maximal number of requests in flight')
+    parser.add_argument('--arrival-rate', type=float, default=0, help='requests per second, 0 sends all at once')
+    parser.add_argument('--timeout', type=int, default=7 * 60, help='timeout of a single request in seconds')
+    parser.add_argument('--executor-threads', type=int, default=0, help='size of the default executor, 0 keeps asyncio default')
+    parser.add_argument('--lag-threshold', type=float, default=100, help='event loop blocking threshold in milliseconds')
+    parser.add_argument('--llm-calls', type=int, default=6, help='LLM calls per request')
+    parser.add_argument('--llm-latency', type=float, default=1.0, help='seconds per fake LLM call')
+    parser.add_argument('--llm-requests-per-minute', type=float, default=10_000, help='throttling quota of the fake endpoint')
+    parser.add_argument('--llm-max-concurrency', type=int, default=64, help='concurrent LLM calls allowed by the rate limiter')
+    parser.add_argument('--sql-calls', type=int, default=3, help='SQL tool calls per request')
+    parser.add_argument('--storage-latency', type=float, default=0.5, help='seconds of the simulated S3 transfers')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    print(json.dumps(asyncio.run(run_load_test(parse_args())), indent=2))
@@ -0,0 +1,146 @@
+"""Process-wide metrics rendered in the Prometheus text exposition format at GET /metrics."""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional, Sequence
+
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _labels(labelnames: Sequence[str], labels: dict) -> Labels:
+    assert set(labels) == set(labelnames), f'expected labels {list(labelnames)}, got {list(labels)}'
+    return tuple((name, str(labels[name])) for name in labelnames)
+
+
+def _format_labels(labels: Labels, extra: Optional[tuple[str, str]] = None) -> str:
+    labels = labels + ((extra,) if extra else ())
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.__values: dict[Labels, float] = {}
+        self.__lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels(self.labelnames, labels)
+        with self.__lock:
+            self.__values[key] = self.__values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self.__values.get(_labels(self.labelnames, labels), 0)
+
+    def items(self) -> list[tuple[Labels, float]]:
+        with self.__lock:
+            return list(self.__values.items())
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self.__lock:
+            lines += [f'{self.name}{_format_labels(key)} {value}' for key, value in self.__values.items()]
+        return lines
+
+
+class Histogram:
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Sequence[str] = (),
+            buckets: Sequence[float] = LATENCY_BUCKETS
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per labels: counts per bucket (last one is +Inf), sum of the observed values
+        self.__values: dict[Labels, tuple[list[int], list[float]]] = {}
+        self.__lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = _labels(self.labelnames, labels)
+        with self.__lock:
+            counts, total = self.__values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self.__lock:
+            for key, (counts, total) in self.__values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else str(bound)
+                    lines.append(f'{self.name}_bucket{_format_labels(key, ("le", le))} {cumulative}')
+                lines.append(f'{self.name}_sum{_format_labels(key)} {total[0]}')
+                lines.append(f'{self.name}_count{_format_labels(key)} {cumulative}')
+        return lines
+
+
+class GaugeCallback:
+    """Gauge whose values are read from `callback` at scrape time, as {labels: value}."""
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], dict[Labels, float]]):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        REGISTRY.append(self)
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        lines += [f'{self.name}{_format_labels(key)} {value}' for key, value in self.callback().items()]
+        return lines
+
+
+REGISTRY: list = []
+
+
+def render_metrics() -> str:
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Latency of API requests.', ['endpoint'])
+REQUEST_TIMEOUTS = Counter('http_request_timeouts_total', 'Requests or batch prompts which timed out.', ['endpoint'])
+BATCH_PROMPT_LATENCY = Histogram('batch_prompt_duration_seconds', 'Time to answer a single prompt of a batch.')
+LLM_LATENCY = Histogram('llm_call_duration_seconds', 'Latency of Bedrock calls until the last streamed chunk, rate limiter wait excluded.', ['model_id'])
+LLM_TOKENS = Counter('llm_tokens_total', 'Tokens sent to and received from Bedrock, cached responses excluded.', ['model_id', 'type'])
+LLM_COST = Counter('llm_cost_dollars_total', 'Cost of Bedrock calls in USD.', ['model_id'])
+LLM_THROTTLED = Counter('llm_throttled_calls_total', 'Bedrock calls rejected with a throttling error.', ['model_id'])
+LLM_AVOIDED_CALLS = Counter('llm_avoided_calls_total', 'LLM chain calls replaced by deterministic parsing.', ['chain'])
+SQL_TOOL_CALLS = Counter('sql_tool_calls_total', 'Calls of the database tools by the agents.', ['tool'])
+SQL_QUERY_LATENCY = Histogram('sql_query_duration_seconds', 'Latency of queries executed on the database.')
+CHART_RENDER_LATENCY = Histogram('chart_render_duration_seconds', 'Time spent executing and rendering chart code.')
+CACHE_LOOKUPS = Counter('cache_lookups_total', 'Cache lookups by cache and result (hit or miss).', ['cache', 'result'])
+
+
+def _cache_hit_ratios() -> dict[Labels, float]:
+    caches = {dict(key)['cache'] for key, _ in CACHE_LOOKUPS.items()}
+    ratios = {}
+    for cache in sorted(caches):
+        hits = CACHE_LOOKUPS.value(cache=cache, result='hit')
+        misses = CACHE_LOOKUPS.value(cache=cache, result='miss')
+        ratios[(('cache', cache),)] = hits / (hits + misses) if hits + misses else 0.0
+    return ratios
+
+
+GaugeCallback('cache_hit_ratio', 'Share of cache lookups which were hits.', _cache_hit_ratios)
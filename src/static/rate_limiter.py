@@ -0,0 +1,318 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Iterator, Optional, TypeVar
+
+import yaml
+
+from src.static.metrics import LLM_THROTTLED, GaugeCallback
+
+T = TypeVar('T')
+
+# Lower value is served first
+INTERACTIVE = 0
+BACKGROUND = 10
+
+# Requests per minute, tokens per minute and maximal number of concurrent calls per model, see load_rate_limits
+DEFAULT_LIMITS = {
+    'anthropic.claude-3-5-sonnet-20240620-v1:0': {'requests_per_minute': 50, 'tokens_per_minute': 400_000, 'max_concurrency': 8},
+    'anthropic.claude-3-haiku-20240307-v1:0': {'requests_per_minute': 1_000, 'tokens_per_minute': 2_000_000, 'max_concurrency': 32},
+    'amazon.titan-text-premier-v1:0': {'requests_per_minute': 100, 'tokens_per_minute': 300_000, 'max_concurrency': 8},
+    'meta.llama3-8b-instruct-v1:0': {'requests_per_minute': 800, 'tokens_per_minute': 300_000, 'max_concurrency': 16},
+    'meta.llama3-70b-instruct-v1:0': {'requests_per_minute': 400, 'tokens_per_minute': 300_000, 'max_concurrency': 16},
+    'mistral.mistral-7b-instruct-v0:2': {'requests_per_minute': 800, 'tokens_per_minute': 300_000, 'max_concurrency': 16},
+    'mistral.mixtral-8x7b-instruct-v0:1': {'requests_per_minute': 400, 'tokens_per_minute': 300_000, 'max_concurrency': 16},
+}
+FALLBACK_LIMITS = {'requests_per_minute': 50, 'tokens_per_minute': 200_000, 'max_concurrency': 8}
+
+# Bounds of the multiplicative decrease and the additive increase of the request rate
+MIN_RATE_FACTOR = 0.02
+RATE_FACTOR_STEP = 0.01
+
+THROTTLING_ERRORS = ['ThrottlingException', 'TooManyRequestsException', 'Too many requests', 'Rate exceeded']
+
+
+def load_rate_limits(path: Optional[str] = None) -> tuple[dict[str, dict[str, float]], dict[str, float]]:
+    """Returns the limits per model and the limits of unlisted models.
+
+    The built-in limits are overridden by the YAML file at `path` or at $RATE_LIMITS_PATH, which maps model ids,
+    or `default` for unlisted models, to any of `requests_per_minute`, `tokens_per_minute` and `max_concurrency`.
+    """
+    path = path or os.getenv('RATE_LIMITS_PATH')
+    overrides = {}
+    if path:
+        with open(path) as f:
+            overrides = yaml.safe_load(f) or {}
+    fallback = {**FALLBACK_LIMITS, **overrides.pop('default', {})}
+    limits = {model_id: dict(model_limits) for model_id, model_limits in DEFAULT_LIMITS.items()}
+    for model_id, model_limits in overrides.items():
+        limits[model_id] = {**limits.get(model_id, fallback), **model_limits}
+    return limits, fallback
+
+
+def is_throttling_error(e: Exception) -> bool:
+    # langchain_aws wraps botocore errors into ValueError, so the message is checked as well
+    response = getattr(e, 'response', None)
+    code = response.get('Error', {}).get('Code', '') if isinstance(response, dict) else ''
+    return code in THROTTLING_ERRORS or any(error in str(e) for error in THROTTLING_ERRORS)
+
+
+class RateLimiter:
+    """Token bucket limiter of requests and tokens per minute for a single model.
+
+    Callers are served in order of priority and arrival. The number of concurrent calls and the request rate
+    are adjusted with AIMD: they are halved on every throttling error and grow back additively with every
+    successful call, so the limiter settles just below the quota Bedrock actually grants.
+    """
+
+    def __init__(
+            self,
+            model_id: str,
+            requests_per_minute: float,
+            tokens_per_minute: float,
+            max_concurrency: int,
+            min_concurrency: int = 1
+    ):
+        self.model_id = model_id
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency_limit = float(max_concurrency)
+        self.rate_factor = 1.0
+
+        self.__condition = threading.Condition()
+        self.__queue: list[tuple[int, int]] = []
+        self.__counter = itertools.count()
+        self.__requests = float(requests_per_minute)
+        self.__tokens = float(tokens_per_minute)
+        self.__refilled_at = time.monotonic()
+        self.__in_flight = 0
+
+        self.__metrics = {
+            'acquired': 0,
+            'throttled': 0,
+            'total_wait_time': 0.0,
+            'max_wait_time': 0.0
+        }
+
+    def __refill(self):
+        now = time.monotonic()
+        elapsed = now - self.__refilled_at
+        self.__refilled_at = now
+        requests_per_minute = self.requests_per_minute * self.rate_factor
+        self.__requests = min(requests_per_minute, self.__requests + elapsed * requests_per_minute / 60)
+        self.__tokens = min(self.tokens_per_minute, self.__tokens + elapsed * self.tokens_per_minute / 60)
+
+    def __time_to_available(self, tokens: float) -> float:
+        # time until both buckets hold enough for the request, 0 when it can be served now
+        missing_requests = max(0.0, 1 - self.__requests)
+        missing_tokens = max(0.0, tokens - self.__tokens)
+        return max(
+            missing_requests * 60 / (self.requests_per_minute * self.rate_factor),
+            missing_tokens * 60 / self.tokens_per_minute
+        )
+
+    def acquire(self, tokens: int, priority: int = INTERACTIVE, timeout: Optional[float] = None) -> bool:
+        """Blocks until a call with `tokens` prompt tokens may be sent. Returns False on timeout."""
+        tokens = min(tokens, self.tokens_per_minute)
+        entry = (priority, next(self.__counter))
+        start_time = time.monotonic()
+        with self.__condition:
+            heapq.heappush(self.__queue, entry)
+            try:
+                while True:
+                    self.__refill()
+                    wait_time = self.__time_to_available(tokens)
+                    if self.__queue[0] == entry and self.__in_flight < int(self.concurrency_limit) and wait_time == 0:
+                        break
+                    if timeout is not None:
+                        remaining = timeout - (time.monotonic() - start_time)
+                        if remaining <= 0:
+                            return False
+                        wait_time = min(wait_time or remaining, remaining)
+                    self.__condition.wait(wait_time or None)
+            finally:
+                self.__queue.remove(entry)
+                heapq.heapify(self.__queue)
+                self.__condition.notify_all()
+
+            self.__requests -= 1
+            self.__tokens -= tokens
+            self.__in_flight += 1
+            waited = time.monotonic() - start_time
+            self.__metrics['acquired'] += 1
+            self.__metrics['total_wait_time'] += waited
+            self.__metrics['max_wait_time'] = max(self.__metrics['max_wait_time'], waited)
+            return True
+
+    def release(self, throttled: bool = False):
+        with self.__condition:
+            self.__in_flight -= 1
+            if throttled:
+                self.__metrics['throttled'] += 1
+                LLM_THROTTLED.inc(model_id=self.model_id)
+                self.concurrency_limit = max(float(self.min_concurrency), self.concurrency_limit / 2)
+                self.rate_factor = max(MIN_RATE_FACTOR, self.rate_factor / 2)
+                # drop the burst allowance so the lowered rate takes effect immediately
+                self.__requests = min(self.__requests, 0.0)
+            else:
+                self.concurrency_limit = min(float(self.max_concurrency), self.concurrency_limit + 1 / self.concurrency_limit)
+                self.rate_factor = min(1.0, self.rate_factor + RATE_FACTOR_STEP)
+            self.__condition.notify_all()
+
+    def record_tokens(self, tokens: int):
+        """Charges tokens known only after the call, e.g. completion tokens, to the bucket."""
+        with self.__condition:
+            self.__tokens -= tokens
+
+    def metrics(self) -> dict[str, Any]:
+        with self.__condition:
+            self.__refill()
+            return {
+                'queue_length': len(self.__queue),
+                'in_flight': self.__in_flight,
+                'concurrency_limit': int(self.concurrency_limit),
+                'requests_per_minute': self.requests_per_minute * self.rate_factor,
+                'available_requests': self.__requests,
+                'available_tokens': self.__tokens,
+                **self.__metrics
+            }
+
+
+_RATE_LIMITERS: dict[str, RateLimiter] = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+
+
+def get_rate_limiter(model_id: str) -> RateLimiter:
+    with _RATE_LIMITERS_LOCK:
+        if model_id not in _RATE_LIMITERS:
+            limits, fallback = load_rate_limits()
+            _RATE_LIMITERS[model_id] = RateLimiter(model_id, **limits.get(model_id, fallback))
+        return _RATE_LIMITERS[model_id]
+
+
+def get_rate_limiter_metrics() -> dict[str, dict[str, Any]]:
+    with _RATE_LIMITERS_LOCK:
+        limiters = list(_RATE_LIMITERS.values())
+    return {limiter.model_id: limiter.metrics() for limiter in limiters}
+
+
+for _name, _documentation in [
+    ('queue_length', 'Calls waiting in the rate limiter.'),
+    ('in_flight', 'Calls sent and not finished yet.'),
+    ('concurrency_limit', 'Current AIMD limit of concurrent calls.'),
+    ('requests_per_minute', 'Current AIMD request rate.')
+]:
+    GaugeCallback(
+        f'rate_limiter_{_name}',
+        _documentation,
+        lambda name=_name: {(('model_id', model_id),): m[name] for model_id, m in get_rate_limiter_metrics().items()}
+    )
+
+
+def call_with_retries(
+        model_id: str,
+        tokens: int,
+        fn: Callable[[], T],
+        priority: int = INTERACTIVE,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0
+) -> T:
+    """Calls `fn` through the rate limiter of `model_id`, retrying throttled calls with jittered exponential backoff."""
+    limiter = get_rate_limiter(model_id)
+    for attempt in range(max_retries + 1):
+        limiter.acquire(tokens, priority=priority)
+        try:
+            result = fn()
+        except Exception as e:
+            throttled = is_throttling_error(e)
+            limiter.release(throttled=throttled)
+            if not throttled or attempt == max_retries:
+                raise
+            time.sleep(_backoff_delay(model_id, attempt, max_retries, base_delay, max_delay))
+        else:
+            limiter.release()
+            return result
+
+
+def _backoff_delay(model_id: str, attempt: int, max_retries: int, base_delay: float, max_delay: float) -> float:
+    delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+    logging.warning(f"Call to {model_id} throttled, retrying in {delay:.2f}s (attempt {attempt + 1}/{max_retries})")
+    return delay
+
+
+def stream_with_retries(
+        model_id: str,
+        tokens: int,
+        open_stream: Callable[[], Iterator[T]],
+        priority: int = INTERACTIVE,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0
+) -> Iterator[T]:
+    """Streams `open_stream()` through the rate limiter of `model_id` like `call_with_retries`.
+
+    A throttled stream is retried only while none of its chunks has been yielded, as they can't be taken back.
+    The call holds its place in the limiter until the last chunk.
+    """
+    limiter = get_rate_limiter(model_id)
+    for attempt in range(max_retries + 1):
+        limiter.acquire(tokens, priority=priority)
+        started = throttled = False
+        try:
+            for chunk in open_stream():
+                started = True
+                yield chunk
+            return
+        except Exception as e:
+            throttled = is_throttling_error(e)
+            if started or not throttled or attempt == max_retries:
+                raise
+        finally:
+            limiter.release(throttled=throttled)
+        time.sleep(_backoff_delay(model_id, attempt, max_retries, base_delay, max_delay))
+
+
+async def _acquire_async(limiter: RateLimiter, tokens: int, priority: int):
+    # acquire blocks its thread, so it waits in the executor instead of the event loop
+    acquiring = asyncio.get_running_loop().run_in_executor(None, lambda: limiter.acquire(tokens, priority=priority))
+    try:
+        await asyncio.shield(acquiring)
+    except asyncio.CancelledError:
+        acquiring.add_done_callback(lambda f: f.cancelled() or f.exception() is not None or limiter.release())
+        raise
+
+
+async def astream_with_retries(
+        model_id: str,
+        tokens: int,
+        open_stream: Callable[[], AsyncIterator[T]],
+        priority: int = INTERACTIVE,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0
+) -> AsyncIterator[T]:
+    """Async counterpart of `stream_with_retries`."""
+    limiter = get_rate_limiter(model_id)
+    for attempt in range(max_retries + 1):
+        await _acquire_async(limiter, tokens, priority)
+        started = throttled = False
+        try:
+            async for chunk in open_stream():
+                started = True
+                yield chunk
+            return
+        except Exception as e:
+            throttled = is_throttling_error(e)
+            if started or not throttled or attempt == max_retries:
+                raise
+        finally:
+            limiter.release(throttled=throttled)
+        await asyncio.sleep(_backoff_delay(model_id, attempt, max_retries, base_delay, max_delay))
@@ -0,0 +1,191 @@
+"""Batch evaluation of many prompts sharing retrieval, database and LLM caches.
+
+Usage example:
+python -m src.submission.batch prompts.txt --parallelism 4 > results.jsonl
+"""
+import argparse
+import asyncio
+import contextvars
+import datetime as dt
+import json
+import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Optional
+
+import dotenv
+from async_timeout import timeout
+from langchain_core.caches import InMemoryCache, RETURN_VAL_TYPE
+
+from src.static.ChatBedrockWrapper import TOKEN_COUNTER, get_total_number_of_tokens, get_total_cost, get_token_details
+from src.static.metrics import BATCH_PROMPT_LATENCY, CACHE_LOOKUPS, REQUEST_LATENCY, REQUEST_TIMEOUTS
+from src.static.rate_limiter import BACKGROUND
+from src.submission.crews.advanced_PIRLS_crew_rag_gdp import AdvancedPIRLSCrew
+from src.submission.extractors import AVOIDED_LLM_CALLS, get_avoided_llm_calls
+from src.submission.routing import ROUTE_COUNTER, ModelRouter
+import src.submission.tools.database as db_tools
+
+dotenv.load_dotenv()
+
+DEFAULT_PARALLELISM = 4
+DEFAULT_TIMEOUT = 7 * 60  # 7 minutes
+
+
+def _new_call_id(index: int) -> str:
+    return dt.datetime.now().strftime("%Y%m%d%H%M%S%f") + f'_batch{index}_{random.randint(0, 1_000_000)}'
+
+
+class CountingInMemoryCache(InMemoryCache):
+    """LLM response cache reporting its hits and misses to the metrics."""
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        ret = super().lookup(prompt, llm_string)
+        CACHE_LOOKUPS.inc(cache='llm', result='miss' if ret is None else 'hit')
+        return ret
+
+
+def create_batch_crew(call_id: str, cache: InMemoryCache) -> AdvancedPIRLSCrew:
+    # batch calls queue behind interactive /run calls in the shared rate limiter
+    router = ModelRouter(call_id=call_id, priority=BACKGROUND, cache=cache)
+    return AdvancedPIRLSCrew(llm=router.get_llm(), router=router)
+
+
+async def run_batch(
+        prompts: list[str],
+        parallelism: int = DEFAULT_PARALLELISM,
+        timeout_per_prompt: Optional[int] = DEFAULT_TIMEOUT
+) -> AsyncIterator[dict[str, Any]]:
+    """Answers all the prompts and yields a result per prompt as soon as it is ready, followed by a summary.
+
+    Retrieval runs once for the whole batch, the crews run `parallelism` at a time and share one LLM
+    response cache as well as a database query cache, both dropped at the end of the batch. When retrieval
+    fails every prompt gets a result with the error.
+
+    The crews run on threads of their own, not on the default executor serving /run. A crew can't be stopped,
+    so a timed out crew keeps its slot until it finishes and the next prompt waits for it.
+    """
+    loop = asyncio.get_event_loop()
+    start_time = loop.time()
+    cache = CountingInMemoryCache()
+    query_cache = db_tools.QueryCache()
+    results = []
+
+    def retrieve_all() -> list[str]:
+        crew = create_batch_crew(_new_call_id(-1), cache)
+        return crew.retrieve(prompts, crew.get_rag_collection())
+
+    new_prompts = None
+    retrieval_error = None
+    if prompts:
+        try:
+            new_prompts = await loop.run_in_executor(None, retrieve_all)
+        except Exception as e:
+            retrieval_error = f'Retrieval failed: {e}'
+    semaphore = asyncio.Semaphore(parallelism)
+    executor = ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix='batch_crew')
+
+    async def run_one(index: int) -> dict[str, Any]:
+        await semaphore.acquire()
+        call_id = _new_call_id(index)
+        TOKEN_COUNTER[call_id] = {}
+        ROUTE_COUNTER[call_id] = {}
+        AVOIDED_LLM_CALLS[call_id] = {}
+
+        def release(_=None):
+            del TOKEN_COUNTER[call_id]
+            ROUTE_COUNTER.pop(call_id, None)
+            AVOIDED_LLM_CALLS.pop(call_id, None)
+            semaphore.release()
+
+        ret = {'index': index, 'prompt': prompts[index], 'result': None, 'time': None, 'timed_out': False}
+        answering = None
+        try:
+            crew = await loop.run_in_executor(executor, create_batch_crew, call_id, cache)
+            # the executor doesn't propagate context variables, so the crew runs in a context holding the cache
+            context = contextvars.copy_context()
+            context.run(db_tools.QUERY_CACHE.set, query_cache)
+            prompt_start_time = loop.time()
+            answering = loop.run_in_executor(executor, context.run, crew.answer, prompts[index], new_prompts[index])
+            async with timeout(timeout_per_prompt):
+                ret['result'] = await asyncio.shield(answering)
+            ret['time'] = loop.time() - prompt_start_time
+            BATCH_PROMPT_LATENCY.observe(ret['time'])
+        except asyncio.TimeoutError:
+            ret['timed_out'] = True
+            REQUEST_TIMEOUTS.inc(endpoint='/run_batch')
+        except Exception as e:
+            ret['error'] = str(e)
+        finally:
+            ret.update({
+                'tokens': get_total_number_of_tokens(call_id),
+                'cost': get_total_cost(call_id),
+                'token_details': get_token_details(call_id),
+                'avoided_llm_calls': get_avoided_llm_calls(call_id)
+            })
+            if answering is not None and not answering.done():
+                # counters and slot are freed once the crew is done, or it would recreate its counters
+                answering.add_done_callback(release)
+            else:
+                release()
+        return ret
+
+    try:
+        if retrieval_error is None:
+            for next_result in asyncio.as_completed([run_one(i) for i in range(len(prompts))]):
+                result = await next_result
+                results.append(result)
+                yield result
+        else:
+            for index, prompt in enumerate(prompts):
+                result = {
+                    'index': index, 'prompt': prompt, 'result': None, 'time': None, 'timed_out': False,
+                    'error': retrieval_error, 'tokens': 0, 'cost': 0.0
+                }
+                results.append(result)
+                yield result
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    REQUEST_LATENCY.observe(loop.time() - start_time, endpoint='/run_batch')
+    times = [r['time'] for r in results if r['time'] is not None]
+    yield {'summary': {
+        'prompts': len(prompts),
+        'succeeded': sum(r['result'] is not None for r in results),
+        'timed_out': sum(r['timed_out'] for r in results),
+        'failed': sum('error' in r for r in results),
+        'tokens': sum(r['tokens'] for r in results),
+        'cost': sum(r['cost'] for r in results),
+        'time': loop.time() - start_time,
+        'mean_prompt_time': sum(times) / len(times) if times else None,
+        'db_cache_hits': query_cache.hits,
+        'db_cache_misses': query_cache.misses,
+        **({'error': retrieval_error} if retrieval_error else {})
+    }}
+
+
+def read_prompts(path: str) -> list[str]:
+    """Reads prompts from a JSON list, a JSONL file of strings or {"prompt": ...} objects, or plain lines."""
+    with open(path) if path != '-' else sys.stdin as f:
+        content = f.read()
+    if content.lstrip().startswith('['):
+        return json.loads(content)
+    prompts = []
+    for line in filter(None, map(str.strip, content.splitlines())):
+        if line.startswith('{') or line.startswith('"'):
+            line = json.loads(line)
+            line = line['prompt'] if isinstance(line, dict) else line
+        prompts.append(line)
+    return prompts
+
+
+async def main(args: argparse.Namespace):
+    async for result in run_batch(read_prompts(args.prompts), args.parallelism, args.timeout):
+        print(json.dumps(result), flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Answer a batch of prompts and print the results as JSONL')
+    parser.add_argument('prompts', help='file with the prompts, - reads from stdin')
+    parser.add_argument('--parallelism', type=int, default=DEFAULT_PARALLELISM, help='number of crews running at once')
+    parser.add_argument('--timeout', type=int, default=DEFAULT_TIMEOUT, help='timeout of a single prompt in seconds')
+    asyncio.run(main(parser.parse_args()))
@@ -1,8 +1,8 @@
 import dotenv
 
-from src.static.ChatBedrockWrapper import ChatBedrockWrapper
 from src.static.submission import Submission
 from src.submission.crews.advanced_PIRLS_crew_rag_gdp import AdvancedPIRLSCrew
+from src.submission.routing import ModelRouter
 
 dotenv.load_dotenv()
 
@@ -12,12 +12,10 @@ dotenv.load_dotenv()
 # number of the arguments and the returned type mustn't be changed.
 # You can modify only the body of this function so that it returned your implementation of the Submission class.
 def create_submission(call_id: str) -> Submission:
-   
-    llm = ChatBedrockWrapper(
-        model_id= 'anthropic.claude-3-5-sonnet-20240620-v1:0',
-        model_kwargs={'temperature': 0},
-        call_id=call_id
-    )
 
-    crew = AdvancedPIRLSCrew(llm=llm)
+    # models per agent and chain are configured in config/models_rag_gdp.yaml
+    router = ModelRouter(call_id=call_id)
+    llm = router.get_llm()
+
+    crew = AdvancedPIRLSCrew(llm=llm, router=router)
     return crew
@@ -1,12 +1,58 @@
+import logging
+import re
+from typing import Optional
+
 from crewai import Agent, Crew, Process, Task
 from crewai.project import CrewBase, agent, crew, task
 
+from src.static.metrics import CHART_RENDER_LATENCY
 from src.static.submission import Submission
 from src.static.util import PROJECT_ROOT
+from src.submission.routing import ModelRouter
+import src.submission.extractors as extractors
 import src.submission.tools.database as db_tools
 import src.submission.tools.research_tools as research_tools
 
 
+SHORT_ANSWER_MAX_WORDS = 120
+DAD_JOKE_MAX_WORDS = 150
+
+
+def _is_not_empty(output: str) -> bool:
+    return bool(output.strip())
+
+
+def _is_short_answer(output: str) -> bool:
+    # a short answer is a sentence or two, not a copy of the whole answer
+    return _is_not_empty(output) and len(output.split()) <= SHORT_ANSWER_MAX_WORDS
+
+
+def _is_dad_joke(output: str) -> bool:
+    # short and without the big headlines the prompt forbids
+    return _is_not_empty(output) and len(output.split()) <= DAD_JOKE_MAX_WORDS \
+        and re.search(r'^#{1,2} ', output, re.MULTILINE) is None
+
+
+def _is_data_science_answer(output: str) -> bool:
+    # one of the four scenarios of data_science_task: a correlation analysis or no insights
+    output = output.lower()
+    return 'correlation coefficient' in output or 'provide any insights' in output
+
+
+def _is_markdown_or_empty(output: str) -> bool:
+    return output.strip() in ["''", ''] or '](' in output
+
+
+def _is_chart_code(output: str) -> bool:
+    if output.strip() == "''":
+        return True
+    try:
+        compile(output, '<chart>', 'exec')
+    except SyntaxError:
+        return False
+    return 'plt' in output
+
+
 @CrewBase
 class AdvancedPIRLSCrew(Submission):
     """Data Analysis Crew for the GDSC project.
@@ -24,8 +70,50 @@ class AdvancedPIRLSCrew(Submission):
     agents_config = PROJECT_ROOT / 'submission' / 'config' / 'agents_rag_gdp.yaml'
     tasks_config = PROJECT_ROOT / 'submission' / 'config' / 'tasks_rag_gdp.yaml'
 
-    def __init__(self, llm):
+    def __init__(self, llm, router: Optional[ModelRouter] = None):
         self.llm = llm
+        self.router = router
+
+    def _agent_llm(self, name: str):
+        """
+        Returns the model routed for the given agent or the default llm when no router is set.
+        """
+        if self.router is None:
+            return self.llm
+        return self.router.llm_for_agent(name)
+
+    def _invoke_chain(self, name: str, template, inputs: dict, validate=None) -> str:
+        """
+        Invokes the chain on the model routed for it, falling back to the stronger model if the output fails validation.
+        """
+        if self.router is None:
+            return (template | self.llm).invoke(inputs).content
+        return self.router.invoke_chain(name, template, inputs, validate=validate)
+
+    def _agent_fallback(self, name: str, task_name: str, validate):
+        """
+        Returns a task callback which re-runs the task on the fallback model of the agent when its output fails validation.
+        The output is replaced in place, so the following tasks of the crew get the corrected one as context.
+        """
+        def callback(output):
+            if self.router is None or validate(output.raw):
+                return
+            self.router.record_validation_failure(name, self._agent_llm(name).model_id)
+            fallback_llm = self.router.fallback_llm_for_agent(name)
+            if fallback_llm is None:
+                return
+            # @task methods are memoized, so this is the task which just ran
+            task = getattr(self, task_name)()
+            fallback_agent = Agent(
+                config=self.agents_config[name],
+                llm=fallback_llm,
+                allow_delegation=False,
+                verbose=True,
+                max_execution_time = 180
+            )
+            logging.info(f"Re-running the task of {name} on {fallback_llm.model_id}")
+            output.raw = self.router.track(name, fallback_llm.model_id, lambda: fallback_agent.execute_task(task), fallback=True)
+        return callback
 
     def run(self, prompt: str) -> str:
         """
@@ -40,8 +128,15 @@ class AdvancedPIRLSCrew(Submission):
         It starts with retrieval part from available sources, then it enhances the original prompt with additional retrieved knowledge and ask the crew to execute the whole process. Once crew returns the answer, it utilizes the chains implemented as additional methods of the class to extract short answer, complex answer (details), visualization and dad joke or meme to the fun section. Everything in order to structure the response properly.
 
         """
-        import random
         # first section is rag - without any crew orchestration
+        collection = self.get_rag_collection()
+        new_prompt = self.retrieve([prompt], collection)[0]
+        return self.answer(prompt, new_prompt)
+
+    def get_rag_collection(self):
+        """
+        Downloads the vector database with external sources from S3 and opens the collection used for retrieval.
+        """
         import boto3
         import os
         
@@ -81,29 +176,57 @@ class AdvancedPIRLSCrew(Submission):
 
         client = chromadb.PersistentClient(path=f"./{directory_name}")
         collection = client.get_collection(name="pirls_2021", embedding_function=default_ef)    
-        
+        return collection
+
+    def retrieve(self, prompts: list[str], collection) -> list[str]:
+        """
+        Retrieves the external knowledge for all the prompts with a single batched query to the collection and enhances each prompt with the knowledge retrieved for it.
+        """
         # retrieval
-        rag_result = collection.query(query_texts = [prompt], n_results=20)
-        
-        # prepare sources of external data
-        sources = [source['source'].replace('https://www.youtube.com/watch?v=2D1RnQhyAZU', '["PIRLS 2021– Findings, IEA Education"](https://www.youtube.com/watch?v=2D1RnQhyAZU)').replace('https://www.youtube.com/watch?v=wACy8bzeOAU', '["What can we learn from PIRLS 2021?, Department of Education, University of Oxford"](https://www.youtube.com/watch?v=wACy8bzeOAU)') for source in rag_result['metadatas'][0]]
-        documents = rag_result['documents'][0]
-        sources_documents = ['source: '+l[0]+', content: '+l[1] for l in list(zip(sources, documents))]
+        rag_result = collection.query(query_texts = prompts, n_results=20)
         
-        # enhance prompt
-        rag_prompt = '.\n'.join(sources_documents).replace('PEARLS', 'PIRLS')
-        new_prompt = f"""
+        new_prompts = []
+        for prompt, metadatas, documents in zip(prompts, rag_result['metadatas'], rag_result['documents']):
+            # prepare sources of external data
+            sources = [source['source'].replace('https://www.youtube.com/watch?v=2D1RnQhyAZU', '["PIRLS 2021– Findings, IEA Education"](https://www.youtube.com/watch?v=2D1RnQhyAZU)').replace('https://www.youtube.com/watch?v=wACy8bzeOAU', '["What can we learn from PIRLS 2021?, Department of Education, University of Oxford"](https://www.youtube.com/watch?v=wACy8bzeOAU)') for source in metadatas]
+            sources_documents = ['source: '+l[0]+', content: '+l[1] for l in list(zip(sources, documents))]
+            
+            # enhance prompt
+            rag_prompt = '.\n'.join(sources_documents).replace('PEARLS', 'PIRLS')
+            new_prompt = f"""
         Answer this query {prompt}.
         Use the knowledge from this source in the final answer if it only helps:
         {rag_prompt}
         And add in the final answer all the sources (unique i.e. only once) of the relevant pieces of this knowledge if it was useful.
         """
-        answer_all = self.crew().kickoff(inputs={'user_question': new_prompt})
+            new_prompts.append(new_prompt)
+        return new_prompts
+
+    def answer(self, prompt: str, new_prompt: str) -> str:
+        """
+        Asks the crew to answer the prompt enhanced with the retrieved knowledge and structures the response with the post-processing chains.
+        """
+        import random
+
+        if self.router is None:
+            answer_all = self.crew().kickoff(inputs={'user_question': new_prompt})
+        else:
+            answer_all = self.router.track('crew', None, lambda: self.crew().kickoff(inputs={'user_question': new_prompt}))
         answer = answer_all.raw
         short_answer = self.short_answer(prompt, answer)
         complex_answer = self.complex_answer(prompt, answer)
-        data_chart_answer = self.data_chart_answer(prompt, answer)
-        chart_markdown = self.extract_markdown_data_scientist(answer_all.tasks_output[0].raw)
+        # skip the llm chains whenever plain parsing of the answers is conclusive
+        if extractors.has_chartable_data(answer) is False:
+            extractors.record_avoided_llm_call(self.llm.call_id, 'data_chart_answer')
+            data_chart_answer = "''"
+        else:
+            data_chart_answer = self.data_chart_answer(prompt, answer)
+        # without a chart the chart section, and so its markdown, is left out
+        chart_markdown = '' if data_chart_answer == "''" else extractors.extract_image_markdown(answer_all.tasks_output[0].raw)
+        if chart_markdown is None:
+            chart_markdown = self.extract_markdown_data_scientist(answer_all.tasks_output[0].raw)
+        else:
+            extractors.record_avoided_llm_call(self.llm.call_id, 'extract_markdown_data_scientist')
         if chart_markdown == "''":
             chart_markdown = ''
         chart_section = ""
@@ -169,9 +292,7 @@ class AdvancedPIRLSCrew(Submission):
             and the following answer: {answer}
             extract from the answer short answer. Contain only answer in short answer, to not add additional text. Please always use relevant emojis to make the answer more visually appealing, to not inform that you have put emojis.
             """)
-        short_answer_chain = short_answer_template | self.llm
-        short_answer = short_answer_chain.invoke({'query': query, 'answer': answer})
-        return short_answer.content
+        return self._invoke_chain('short_answer', short_answer_template, {'query': query, 'answer': answer}, validate=_is_short_answer)
     
     def complex_answer(self, query: str, answer: str) -> str:
         """
@@ -183,9 +304,7 @@ class AdvancedPIRLSCrew(Submission):
             and the following answer: {answer}
             extract a complex well-structured explanation of the answer to the query in the clearly readable markdown format with some clear sections including sources if such where given or bulletpoints but don't add any headlines. You can just bold names of sections and add relevant emoji. But do not include any technical details like SQL code, database codes or tables names or any suggestions for visualization. You can add the tables if you think it's serves the purpose of building a good story. Try to be concise though if possible. Please always use relevant emojis to make the answer more visually appealing e.g. markdown tbale formatting. Do not inform that you have put emojis. prepare all the bulletpoints in a clear markdown format. Place sources at the end of the answer. Please remember to include both names and the links in the sources section
             """)
-        complex_answer_chain = complex_answer_template | self.llm
-        complex_answer = complex_answer_chain.invoke({'query': query, 'answer': answer})
-        return complex_answer.content
+        return self._invoke_chain('complex_answer', complex_answer_template, {'query': query, 'answer': answer}, validate=_is_not_empty)
     
     def data_chart_answer(self, query: str, answer: str) -> str:
         """
@@ -215,9 +334,7 @@ class AdvancedPIRLSCrew(Submission):
             - Do not use plt.show(), do not add plt.show() to this code. Do not include any other line of code which actually displays the plot. plt must be created and must not be displayed 
             Provide only the python code as the response, to not add additional text. Keep formating in best programming practices. Each new operation start from new line of code.
             """)
-        data_chart_answer_chain = data_chart_answer_template | self.llm
-        data_chart_answer = data_chart_answer_chain.invoke({'query': query, 'answer': answer})
-        return data_chart_answer.content
+        return self._invoke_chain('data_chart_answer', data_chart_answer_template, {'query': query, 'answer': answer}, validate=_is_chart_code)
     
     def extract_markdown_data_scientist(self, answer: str) -> str:
         """
@@ -229,9 +346,7 @@ class AdvancedPIRLSCrew(Submission):
             extract only the markdown part used for visualization. Do not change anything. Just extract it. dont add anything This must be a working markdown.
             If there is nothing relevant just return empty string ''
             """)
-        extract_markdown_chain = extract_markdown_template | self.llm
-        markdown = extract_markdown_chain.invoke({'answer': answer})
-        return markdown.content
+        return self._invoke_chain('extract_markdown_data_scientist', extract_markdown_template, {'answer': answer}, validate=_is_markdown_or_empty)
     
     def dad_joke(self, query: str, answer: str) -> str:
         """
@@ -244,9 +359,7 @@ class AdvancedPIRLSCrew(Submission):
             provide a dad joke relevant to this query and answer. Be creative but stick to the topic. Be funny. Use emojis and format it in markdown with some styling but don't use big headlines.
             Provide only the content of the joke with styling without any additional text without repeating the answer, without anything which is not your dad joke.
             """)
-        dad_joke_answer_chain = dad_joke_answer_template | self.llm
-        dad_joke_answer = dad_joke_answer_chain.invoke({'query': query, 'answer': answer})
-        return dad_joke_answer.content
+        return self._invoke_chain('dad_joke', dad_joke_answer_template, {'query': query, 'answer': answer}, validate=_is_dad_joke)
 
     def random_string(self, length: int) -> str:
         """
@@ -267,10 +380,11 @@ class AdvancedPIRLSCrew(Submission):
         import boto3
         import io
 
-        exec(code)
         img_data = io.BytesIO()
-        plt.savefig(img_data, format='png', dpi=300, bbox_inches='tight')
-        plt.close()
+        with CHART_RENDER_LATENCY.time():
+            exec(code)
+            plt.savefig(img_data, format='png', dpi=300, bbox_inches='tight')
+            plt.close()
 
         filename = self.random_string(20)
 
@@ -294,7 +408,7 @@ class AdvancedPIRLSCrew(Submission):
         """
         a = Agent(
             config=self.agents_config['lead_data_analyst'],
-            llm=self.llm,
+            llm=self._agent_llm('lead_data_analyst'),
             allow_delegation=True,
             verbose=True
         )
@@ -307,7 +421,7 @@ class AdvancedPIRLSCrew(Submission):
         """
         a = Agent(
             config=self.agents_config['data_engineer'],
-            llm=self.llm,
+            llm=self._agent_llm('data_engineer'),
             allow_delegation=False,
             verbose=True,
             max_execution_time = 300,
@@ -328,7 +442,7 @@ class AdvancedPIRLSCrew(Submission):
         """
         a = Agent(
             config=self.agents_config['chart_preparer'],
-            llm=self.llm,
+            llm=self._agent_llm('chart_preparer'),
             allow_delegation=False,
             verbose=True,
             max_execution_time = 180,
@@ -345,7 +459,7 @@ class AdvancedPIRLSCrew(Submission):
         """
         a = Agent(
             config=self.agents_config['data_scientist'],
-            llm=self.llm,
+            llm=self._agent_llm('data_scientist'),
             allow_delegation=False,
             verbose=True,
             max_execution_time = 180
@@ -359,7 +473,8 @@ class AdvancedPIRLSCrew(Submission):
         """
         t = Task(
             config=self.tasks_config['data_science_task'],
-            agent=self.data_scientist()
+            agent=self.data_scientist(),
+            callback=self._agent_fallback('data_scientist', 'data_science_task', _is_data_science_answer)
         )
         return t
     
@@ -0,0 +1,97 @@
+import re
+from collections import defaultdict
+from typing import Optional
+
+from src.static.metrics import LLM_AVOIDED_CALLS
+
+AVOIDED_LLM_CALLS: dict[str, dict[str, int]] = defaultdict(lambda: {})
+
+IMAGE_MARKDOWN = re.compile(r'!\[[^\]\n]*\]\([^)\s]+(?:\s+"[^"\n]*")?\)')
+LINK = re.compile(r'\]\(|https?://')
+NUMBER = re.compile(r'(?<![\w.])[-+]?\d[\d,]*(?:\.\d+)?%?(?!\w|\.\d)')
+YEAR = re.compile(r'^(19|20)\d{2}$')
+MD_TABLE_SEPARATOR = re.compile(r'^\|?\s*:?-{3,}:?\s*(\|\s*:?-{3,}:?\s*)*\|?$')
+
+MIN_SERIES_LENGTH = 2
+
+
+def record_avoided_llm_call(call_id: str, chain: str):
+    AVOIDED_LLM_CALLS[call_id][chain] = AVOIDED_LLM_CALLS[call_id].get(chain, 0) + 1
+    LLM_AVOIDED_CALLS.inc(chain=chain)
+
+
+def get_avoided_llm_calls(call_id: str) -> dict[str, int]:
+    return dict(AVOIDED_LLM_CALLS[call_id])
+
+
+def extract_image_markdown(text: str) -> Optional[str]:
+    """Returns the image markdown found in `text`, '' when it surely has none or None when unsure."""
+    images = IMAGE_MARKDOWN.findall(text)
+    if images:
+        return '\n\n'.join(dict.fromkeys(image.strip() for image in images))
+    if LINK.search(text) is None:
+        return ''
+    # links which are not plain image markdown are left to the llm
+    return None
+
+
+def _split_markdown_row(line: str) -> list[str]:
+    return [cell.strip() for cell in line.strip().strip('|').split('|')]
+
+
+def extract_tables(text: str) -> list[list[list[str]]]:
+    """Extracts markdown and csv tables from `text` as lists of rows, header row included."""
+    tables = []
+    current: list[list[str]] = []
+    current_kind = None
+
+    def flush():
+        nonlocal current, current_kind
+        if len(current) >= 2:
+            tables.append(current)
+        current, current_kind = [], None
+
+    for line in text.splitlines():
+        line = line.strip().strip('`')
+        if line.startswith('|') and line.count('|') >= 2:
+            if current_kind != 'markdown':
+                flush()
+                current_kind = 'markdown'
+            if not MD_TABLE_SEPARATOR.match(line):
+                current.append(_split_markdown_row(line))
+        elif line.count(',') >= 1 and '. ' not in line:
+            cells = [cell.strip() for cell in line.split(',')]
+            if current_kind != 'csv' or len(cells) != len(current[0]):
+                flush()
+                current_kind = 'csv'
+            current.append(cells)
+        else:
+            flush()
+    flush()
+    return tables
+
+
+def _is_number(cell: str) -> bool:
+    return NUMBER.fullmatch(cell.strip().strip('*')) is not None
+
+
+def _numbers_in_prose(text: str) -> list[str]:
+    return [n for n in NUMBER.findall(text) if not YEAR.match(n)]
+
+
+def has_chartable_data(text: str) -> Optional[bool]:
+    """Tells whether `text` holds a numeric series worth charting.
+
+    Returns True when a table has a numeric column with at least MIN_SERIES_LENGTH rows, False when the
+    text holds neither such a table nor MIN_SERIES_LENGTH numbers, and None when it can't be decided.
+    """
+    for table in extract_tables(text):
+        rows = table[1:]
+        if len(rows) < MIN_SERIES_LENGTH:
+            continue
+        for column in range(len(table[0])):
+            if all(column < len(row) and _is_number(row[column]) for row in rows):
+                return True
+    if len(_numbers_in_prose(text)) < MIN_SERIES_LENGTH:
+        return False
+    return None
@@ -0,0 +1,192 @@
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Callable, Optional, TypeVar
+
+import yaml
+from botocore.config import Config
+from langchain_core.caches import BaseCache
+from langchain_core.prompts import ChatPromptTemplate
+
+from src.static.ChatBedrockWrapper import TOKEN_COSTS, TOKEN_COUNTER, ChatBedrockWrapper
+from src.static.rate_limiter import INTERACTIVE
+from src.static.util import PROJECT_ROOT
+
+T = TypeVar('T')
+
+ROUTE_COUNTER: dict[str, dict[str, dict[str, Any]]] = defaultdict(lambda: {})
+
+
+def get_route_details(call_id: str) -> dict:
+    return {
+        route: {**values, 'cost_per_model': dict(values['cost_per_model'])}
+        for route, values in ROUTE_COUNTER[call_id].items()
+    }
+
+
+def _empty_route_metrics() -> dict[str, Any]:
+    return {
+        'model_id': None,
+        'calls': 0,
+        'fallbacks': 0,
+        'validation_failures': 0,
+        'latency': 0.0,
+        'total_cost': 0.0,
+        'cost_per_model': {}
+    }
+
+
+def _cost_per_model(call_id: str) -> dict[str, float]:
+    return {model_id: values['total_cost'] for model_id, values in TOKEN_COUNTER[call_id].items()}
+
+
+class ModelRouter:
+    """Hands every agent and post-processing chain of a crew its own model.
+
+    Routes are read from a YAML file with a `default` model and per-name overrides in the `agents` and
+    `chains` sections. Latency and cost of each route are collected in ROUTE_COUNTER under `call_id`.
+    """
+    config_path = PROJECT_ROOT / 'submission' / 'config' / 'models_rag_gdp.yaml'
+
+    def __init__(
+            self,
+            call_id: str,
+            config_path: Optional[Path] = None,
+            priority: int = INTERACTIVE,
+            cache: Optional[BaseCache] = None
+    ):
+        self.call_id = call_id
+        self.priority = priority
+        self.cache = cache
+        with open(config_path or self.config_path) as f:
+            config = yaml.safe_load(f)
+        self.default = config['default']
+        self.agents = config.get('agents') or {}
+        self.chains = config.get('chains') or {}
+        self.__llms: dict[str, ChatBedrockWrapper] = {}
+        self.__local = threading.local()
+        self.__check_model_ids()
+
+    def __check_model_ids(self):
+        # an unknown model would otherwise fail with a KeyError in the middle of a request, once its tokens are counted
+        for section in [self.agents, self.chains]:
+            for name in section:
+                route = self.__get_route(section, name)
+                for model_id in [route['model_id'], route['fallback_model_id']]:
+                    if model_id is not None and model_id not in TOKEN_COSTS:
+                        raise ValueError(f'Model {model_id} of {name} has no token costs, use one of {list(TOKEN_COSTS)}')
+        if self.default['model_id'] not in TOKEN_COSTS:
+            raise ValueError(f'Default model {self.default["model_id"]} has no token costs, use one of {list(TOKEN_COSTS)}')
+
+    def get_llm(self, model_id: Optional[str] = None, model_kwargs: Optional[dict] = None) -> ChatBedrockWrapper:
+        model_id = model_id or self.default['model_id']
+        model_kwargs = model_kwargs if model_kwargs is not None else self.default.get('model_kwargs', {})
+        key = f'{model_id}|{sorted(model_kwargs.items())}'
+        if key not in self.__llms:
+            self.__llms[key] = ChatBedrockWrapper(
+                model_id=model_id,
+                model_kwargs=dict(model_kwargs),
+                call_id=self.call_id,
+                priority=self.priority,
+                cache=self.cache,
+                # retries of throttled calls are scheduled by the shared rate limiter instead of botocore
+                config=Config(retries={'total_max_attempts': 1}),
+                endpoint_url=os.environ.get('BEDROCK_ENDPOINT_URL')
+            )
+        return self.__llms[key]
+
+    def __get_route(self, section: dict, name: str) -> dict:
+        route = section.get(name) or {}
+        if isinstance(route, str):
+            route = {'model_id': route}
+        return {
+            'model_id': route.get('model_id', self.default['model_id']),
+            'model_kwargs': route.get('model_kwargs', self.default.get('model_kwargs', {})),
+            'fallback_model_id': route.get('fallback_model_id')
+        }
+
+    def llm_for_agent(self, name: str) -> ChatBedrockWrapper:
+        route = self.__get_route(self.agents, name)
+        return self.get_llm(route['model_id'], route['model_kwargs'])
+
+    def fallback_llm_for_agent(self, name: str) -> Optional[ChatBedrockWrapper]:
+        route = self.__get_route(self.agents, name)
+        if not route['fallback_model_id'] or route['fallback_model_id'] == route['model_id']:
+            return None
+        return self.get_llm(route['fallback_model_id'], route['model_kwargs'])
+
+    def record_validation_failure(self, route: str, model_id: str):
+        if route not in ROUTE_COUNTER[self.call_id]:
+            ROUTE_COUNTER[self.call_id][route] = _empty_route_metrics()
+        ROUTE_COUNTER[self.call_id][route]['validation_failures'] += 1
+        logging.warning(f"Output of {route} on model {model_id} failed validation")
+
+    def track(self, route: str, model_id: Optional[str], fn: Callable[[], T], fallback: bool = False) -> T:
+        """Runs `fn` and records its latency and its cost, in total and per model, under `route`.
+
+        Routes tracked while `fn` runs, e.g. an agent re-run within the crew, are recorded under their own
+        name only, so the routes of a request never overlap and add up to its totals.
+        """
+        if route not in ROUTE_COUNTER[self.call_id]:
+            ROUTE_COUNTER[self.call_id][route] = _empty_route_metrics()
+        metrics = ROUTE_COUNTER[self.call_id][route]
+        if not hasattr(self.__local, 'tracked'):
+            self.__local.tracked = []
+        tracked = self.__local.tracked
+        nested = {'latency': 0.0, 'cost_per_model': {}}
+        tracked.append(nested)
+        cost_before = _cost_per_model(self.call_id)
+        start_time = time.perf_counter()
+        try:
+            return fn()
+        finally:
+            tracked.pop()
+            latency = time.perf_counter() - start_time
+            costs = {
+                model: cost - cost_before.get(model, 0.0)
+                for model, cost in _cost_per_model(self.call_id).items()
+                if cost != cost_before.get(model, 0.0)
+            }
+            metrics['model_id'] = model_id
+            metrics['calls'] += 1
+            metrics['fallbacks'] += int(fallback)
+            metrics['latency'] += latency - nested['latency']
+            for model, cost in costs.items():
+                cost -= nested['cost_per_model'].get(model, 0.0)
+                if cost:
+                    metrics['cost_per_model'][model] = metrics['cost_per_model'].get(model, 0.0) + cost
+                    metrics['total_cost'] += cost
+            if tracked:
+                tracked[-1]['latency'] += latency
+                for model, cost in costs.items():
+                    tracked[-1]['cost_per_model'][model] = tracked[-1]['cost_per_model'].get(model, 0.0) + cost
+
+    def invoke_chain(
+            self,
+            name: str,
+            template: ChatPromptTemplate,
+            inputs: dict,
+            validate: Optional[Callable[[str], bool]] = None
+    ) -> str:
+        """Invokes `template` on the model routed for chain `name`.
+
+        When `validate` rejects the output and the route has a `fallback_model_id`, the chain is run once
+        more on the fallback model and its output is returned.
+        """
+        route = self.__get_route(self.chains, name)
+        model_ids = [route['model_id']]
+        if route['fallback_model_id'] and route['fallback_model_id'] != route['model_id']:
+            model_ids.append(route['fallback_model_id'])
+
+        content = ''
+        for attempt, model_id in enumerate(model_ids):
+            chain = template | self.get_llm(model_id, route['model_kwargs'])
+            result = self.track(name, model_id, lambda: chain.invoke(inputs), fallback=attempt > 0)
+            content = result.content if isinstance(result.content, str) else ''
+            if validate is None or validate(content):
+                return content
+            self.record_validation_failure(name, model_id)
+        return content
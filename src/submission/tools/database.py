@@ -1,7 +1,66 @@
+import threading
+from collections import OrderedDict
+from contextvars import ContextVar
 from langchain_core.tools import tool
 from sqlalchemy import text
+from src.static.metrics import CACHE_LOOKUPS, SQL_QUERY_LATENCY, SQL_TOOL_CALLS
 from src.static.util import ENGINE
-from typing import Literal
+from src.submission.tools.formatting import format_result
+from typing import Callable, Literal, Optional
+
+QUERY_CACHE_SIZE = 256
+
+
+class QueryCache:
+    """Bounded LRU cache of formatted query results.
+
+    The PIRLS database is read only, so the prompts of one batch asking for the same data can share the
+    results. Only the formatted, truncated strings are kept and failing queries are not cached.
+    """
+
+    def __init__(self, maxsize: int = QUERY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.__values: OrderedDict[str, str] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, query: str, execute: Callable[[], str]) -> str:
+        with self.__lock:
+            if query in self.__values:
+                self.__values.move_to_end(query)
+                self.hits += 1
+                CACHE_LOOKUPS.inc(cache='db_query', result='hit')
+                return self.__values[query]
+            self.misses += 1
+        CACHE_LOOKUPS.inc(cache='db_query', result='miss')
+        ret = execute()
+        with self.__lock:
+            self.__values[query] = ret
+            self.__values.move_to_end(query)
+            if len(self.__values) > self.maxsize:
+                self.__values.popitem(last=False)
+        return ret
+
+
+# set by run_batch for the crews of a batch, single requests query the database directly
+QUERY_CACHE: ContextVar[Optional[QueryCache]] = ContextVar('query_cache', default=None)
+
+
+def execute_query(query: str) -> tuple[tuple, tuple]:
+    """Executes the query and returns its column names and rows."""
+    with SQL_QUERY_LATENCY.time(), ENGINE.connect() as connection:
+        res = connection.execute(text(query))
+        return tuple(res.keys()), tuple(res.fetchall())
+
+
+def _query_formatted(query: str, tool_name: str) -> str:
+    SQL_TOOL_CALLS.inc(tool=tool_name)
+    cache = QUERY_CACHE.get()
+    if cache is None:
+        return format_result(*execute_query(query))
+    return cache.get(query, lambda: format_result(*execute_query(query)))
+
 
 
 @tool
@@ -39,18 +98,10 @@ def get_answers_to_question(
         WHERE ATab.Code in ({in_clause})
     """
 
-    with ENGINE.connect() as connection:
-#    with db_engine.connect() as connection:
-        try:
-            res = connection.execute(text(query))
-        except Exception as e:
-            return f'Wrong query, encountered exception {e}.'
-
-    ret = ""
-    for result in res:
-        ret += ", ".join(map(str, result)) + "\n"
-
-    return ret
+    try:
+        return _query_formatted(query, 'get_answers_to_question')
+    except Exception as e:
+        return f'Wrong query, encountered exception {e}.'
 
 @tool
 def query_database(query: str) -> str:
@@ -60,7 +111,8 @@ def query_database(query: str) -> str:
         query (str): The SQL query to execute.
 
     Returns:
-        str: The results of the query as a string, where each row is separated by a newline.
+        str: The results of the query as a string: a header line followed by tab separated rows.
+        Long results are truncated and the omitted rows are summarized.
 
     Raises:
         Exception: If the query is invalid or encounters an exception during execution.
@@ -71,15 +123,9 @@ def query_database(query: str) -> str:
     #     return 'WARNING! The query you are about to perform has no record limitations! In case of large tables and ' \
     #            'joins this will return an incomprehensible output.'
 
-    with ENGINE.connect() as connection:
-        try:
-            res = connection.execute(text(query))
-        except Exception as e:
-            return f'Wrong query, encountered exception {e}.'
-
-    max_result_len = 3_000
-    ret = '\n'.join(", ".join(map(str, result)) for result in res)
-    if len(ret) > max_result_len:
-        ret = ret[:max_result_len] + '...\n(results too long. Output truncated.)'
+    try:
+        ret = _query_formatted(query.strip(), 'query_database')
+    except Exception as e:
+        return f'Wrong query, encountered exception {e}.'
 
     return f'Query: {query}\nResult: {ret}'
\ No newline at end of file
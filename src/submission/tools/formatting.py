@@ -0,0 +1,158 @@
+from decimal import Decimal
+from functools import lru_cache
+from typing import Any, Callable, Literal, Sequence
+
+MAX_RESULT_TOKENS = 1_000
+DITTO = '"'
+NULL = 'NULL'
+
+
+@lru_cache(maxsize=1)
+def _get_tokenizer() -> Callable[[str], int]:
+    # Same tokenizer ChatBedrock counts Anthropic tokens with, with a tiktoken fallback. It is loaded once here,
+    # as get_num_tokens_anthropic creates a new client and tokenizer on every call.
+    try:
+        import anthropic
+        tokenizer = anthropic.Anthropic(api_key='unused').get_tokenizer()
+        return lambda text: len(tokenizer.encode(text).ids)
+    except Exception:
+        import tiktoken
+        encoding = tiktoken.get_encoding('cl100k_base')
+        return lambda text: len(encoding.encode(text))
+
+
+def count_tokens(text: str) -> int:
+    return _get_tokenizer()(text)
+
+
+def _is_numeric(value: Any) -> bool:
+    return isinstance(value, (int, float, Decimal)) and not isinstance(value, bool)
+
+
+def format_value(value: Any) -> str:
+    """Render a single cell compactly: no `None`/`Decimal(...)` reprs and sensibly rounded numerics."""
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return str(value)
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, (float, Decimal)):
+        value = float(value)
+        if value.is_integer():
+            return str(int(value))
+        # 2 decimals for regular magnitudes, 3 significant digits for small fractions
+        ret = f'{value:.2f}' if abs(value) >= 1 else f'{value:.3g}'
+        return ret.rstrip('0').rstrip('.') if '.' in ret and 'e' not in ret else ret
+    return str(value).replace('\t', ' ').replace('\n', ' ')
+
+
+def _render_row(cells: Sequence[str], fmt: str) -> str:
+    if fmt == 'markdown':
+        return '| ' + ' | '.join(cell.replace('|', '\\|') for cell in cells) + ' |'
+    return '\t'.join(cells)
+
+
+def _is_empty(value: Any) -> bool:
+    return value is None or value == ''
+
+
+def _summarize_dropped(columns: list[str], kept: list[int], numeric: list[bool], rows: list, dropped: list) -> str:
+    summary = [f'... {len(dropped)} more rows omitted ({len(rows)} rows in total).']
+    for i in kept:
+        values = [row[i] for row in dropped if row[i] is not None]
+        if numeric[i] and values:
+            summary.append(f'{columns[i]}: min={format_value(min(values))}, max={format_value(max(values))}')
+    if len(summary) > 1:
+        summary[0] += ' Omitted rows range:'
+    return '\n'.join(summary)
+
+
+def format_result(
+        columns: Sequence[str],
+        rows: Sequence[Sequence[Any]],
+        max_tokens: int = MAX_RESULT_TOKENS,
+        fmt: Literal['tsv', 'markdown'] = 'tsv'
+) -> str:
+    """Format query results as a header plus compact TSV or markdown table.
+
+    Columns holding a single value for every row are lifted out into one `constant:` line, and repeated
+    values in text columns are replaced by a ditto mark, explained by a legend line above the table. Rows
+    are added until `max_tokens` (measured with the model's tokenizer) is reached; the dropped rows are
+    then summarized by their count and the min/max of every numeric column, within the same budget.
+
+    Args:
+        columns (Sequence[str]): column names of the result.
+        rows (Sequence[Sequence[Any]]): result rows.
+        max_tokens (int): token budget of the returned string.
+        fmt (str): either 'tsv' or 'markdown'.
+
+    Returns:
+        str: formatted result.
+    """
+    assert fmt in ['tsv', 'markdown'], f'format "{fmt}" is not supported'
+    columns = list(columns)
+    rows = [list(row) for row in rows]
+    if not rows:
+        return _render_row(columns, fmt) + '\n(no rows)'
+
+    numeric = [all(_is_numeric(row[i]) or row[i] is None for row in rows) for i in range(len(columns))]
+    constant = [len(rows) > 1 and all(row[i] == rows[0][i] for row in rows) for i in range(len(columns))]
+    if all(constant):
+        constant = [False] * len(columns)
+    kept = [i for i in range(len(columns)) if not constant[i]]
+
+    prefix = []
+    if any(constant):
+        prefix.append('constant: ' + ', '.join(
+            f'{columns[i]}={NULL if _is_empty(rows[0][i]) else format_value(rows[0][i])}' for i in range(len(columns)) if constant[i]
+        ))
+    header = [_render_row([columns[i] for i in kept], fmt)]
+    if fmt == 'markdown':
+        header.append(_render_row(['---'] * len(kept), fmt))
+    legend = f'({DITTO} = same as row above)'
+
+    row_lines, row_dittos = [], []
+    previous = None
+    for row in rows:
+        dittos = [
+            previous is not None and not numeric[i] and not _is_empty(row[i]) and row[i] == previous[i]
+            for i in kept
+        ]
+        cells = [DITTO if ditto else format_value(row[i]) for ditto, i in zip(dittos, kept)]
+        if not any(cells):
+            # a row of empty cells would render as a blank line
+            cells = [NULL if _is_empty(row[i]) else cell for cell, i in zip(cells, kept)]
+        row_lines.append(_render_row(cells, fmt))
+        row_dittos.append(any(dittos))
+        previous = row
+
+    def render(n_rows: int) -> str:
+        # the legend goes before the table, and only when a ditto mark is actually used
+        lines = prefix + ([legend] if any(row_dittos[:n_rows]) else []) + header + row_lines[:n_rows]
+        if n_rows < len(rows):
+            lines.append(_summarize_dropped(columns, kept, numeric, rows, rows[n_rows:]))
+        return '\n'.join(lines)
+
+    # every line is counted once, the table of the first n rows takes table_tokens[n]
+    legend_tokens = count_tokens(legend) + 1
+    first_ditto = row_dittos.index(True) if any(row_dittos) else None
+    table_tokens = [count_tokens('\n'.join(prefix + header))]
+    for i, line in enumerate(row_lines):
+        table_tokens.append(table_tokens[-1] + count_tokens(line) + 1 + (legend_tokens if i == first_ditto else 0))
+
+    def total_tokens(n_rows: int) -> int:
+        if n_rows == len(rows):
+            return table_tokens[n_rows]
+        return table_tokens[n_rows] + count_tokens(_summarize_dropped(columns, kept, numeric, rows, rows[n_rows:])) + 1
+
+    # binary search of the most rows fitting in the budget together with the summary of the dropped ones,
+    # the first row is always kept
+    low, high = 1, len(rows)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if total_tokens(middle) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return render(low)
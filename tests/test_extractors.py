@@ -0,0 +1,50 @@
+from src.submission.extractors import extract_image_markdown, extract_tables, has_chartable_data
+
+
+def test_extract_image_markdown():
+    answer = (
+        'Correlation analysis:\n- GDP: 0.587\nVisualization:\n'
+        '![Score vs GDP](https://bucket.s3.amazonaws.com/score_vs_gdp.png)\n\n'
+        '![Score vs GDP](https://bucket.s3.amazonaws.com/score_vs_gdp.png)\n'
+        '![Score vs life expectancy](https://bucket.s3.amazonaws.com/score_vs_life.png)'
+    )
+    assert extract_image_markdown(answer) == (
+        '![Score vs GDP](https://bucket.s3.amazonaws.com/score_vs_gdp.png)\n\n'
+        '![Score vs life expectancy](https://bucket.s3.amazonaws.com/score_vs_life.png)'
+    )
+
+
+def test_extract_image_markdown_without_links_is_empty():
+    assert extract_image_markdown("I can't provide any insights to this question") == ''
+
+
+def test_extract_image_markdown_is_unsure_about_other_links():
+    assert extract_image_markdown('See [the report](https://pirls2021.org/data)') is None
+
+
+def test_extract_tables():
+    text = 'Results:\n| Country | Score |\n|---|---|\n| Poland | 549 |\n| Spain | 521 |\n\ncountry,score\nA,1\nB,2'
+    assert extract_tables(text) == [
+        [['Country', 'Score'], ['Poland', '549'], ['Spain', '521']],
+        [['country', 'score'], ['A', '1'], ['B', '2']]
+    ]
+
+
+def test_has_chartable_data_with_tables():
+    assert has_chartable_data('| Country | Score |\n|---|---|\n| Poland | 549 |\n| Spain | 521.5 |') is True
+    assert has_chartable_data('country,score\nPoland,549\nSpain,521') is True
+
+
+def test_has_chartable_data_without_numbers():
+    assert has_chartable_data('Yes, you can cook a cake.') is False
+    # years are not a series
+    assert has_chartable_data('PIRLS was run in 2021.') is False
+    assert has_chartable_data('About 4 of them.') is False
+
+
+def test_has_chartable_data_is_unsure_about_numbers_in_prose():
+    assert has_chartable_data('Company Y has revenue of 250. Company Z follows with 155.') is None
+
+
+def test_single_row_table_is_not_a_series():
+    assert has_chartable_data('| Country | Score |\n|---|---|\n| Poland | 549 |') is False
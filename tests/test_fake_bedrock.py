@@ -0,0 +1,78 @@
+import base64
+import json
+import struct
+import urllib.request
+import zlib
+
+import pytest
+
+from src.static import fake_bedrock
+
+
+@pytest.fixture
+def url():
+    server, _ = fake_bedrock.serve(port=0, requests_per_minute=600, latency=0)
+    yield f'http://localhost:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def decode_events(data: bytes) -> list[tuple[dict, dict]]:
+    # decoder of the AWS event stream encoding, as specified, independent of encode_event
+    events = []
+    while data:
+        total_length, headers_length, prelude_crc = struct.unpack('>III', data[:12])
+        assert prelude_crc == zlib.crc32(data[:8])
+        assert struct.unpack('>I', data[total_length - 4:total_length])[0] == zlib.crc32(data[:total_length - 4])
+        headers, position = {}, 12
+        while position < 12 + headers_length:
+            name_length = data[position]
+            name = data[position + 1:position + 1 + name_length].decode()
+            value_type, value_length = struct.unpack('>BH', data[position + 1 + name_length:position + 4 + name_length])
+            assert value_type == 7
+            headers[name] = data[position + 4 + name_length:position + 4 + name_length + value_length].decode()
+            position += 4 + name_length + value_length
+        payload = json.loads(data[12 + headers_length:total_length - 4])
+        events.append((headers, json.loads(base64.b64decode(payload['bytes']))))
+        data = data[total_length:]
+    return events
+
+
+def stream(url: str, body: dict) -> tuple[str, bytes]:
+    request = urllib.request.Request(
+        f'{url}/model/anthropic.claude-3-haiku-20240307-v1%3A0/invoke-with-response-stream',
+        json.dumps(body).encode(),
+        {'Content-Type': 'application/json'}
+    )
+    with urllib.request.urlopen(request) as response:
+        return response.headers['Content-Type'], response.read()
+
+
+def test_messages_are_streamed_as_event_stream(url):
+    content_type, data = stream(url, {'messages': [{'role': 'user', 'content': 'question'}]})
+    events = decode_events(data)
+    assert content_type == 'application/vnd.amazon.eventstream'
+    assert all(headers == {':event-type': 'chunk', ':content-type': 'application/json', ':message-type': 'event'} for headers, _ in events)
+    payloads = [payload for _, payload in events]
+    assert payloads[0]['type'] == 'message_start'
+    assert payloads[0]['message']['model'] == 'anthropic.claude-3-haiku-20240307-v1:0'
+    assert payloads[-1]['type'] == 'message_stop'
+    text = ''.join(p['delta']['text'] for p in payloads if p['type'] == 'content_block_delta')
+    assert text == fake_bedrock.DEFAULT_REPLY
+
+
+def test_completions_are_streamed_as_event_stream(url):
+    _, data = stream(url, {'prompt': 'question'})
+    assert [payload for _, payload in decode_events(data)] == [
+        {'completion': fake_bedrock.DEFAULT_REPLY, 'stop_reason': 'stop_sequence'}
+    ]
+
+
+def test_botocore_decodes_the_event_stream(url):
+    eventstream = pytest.importorskip('botocore.eventstream')
+    _, data = stream(url, {'messages': [{'role': 'user', 'content': 'question'}]})
+    buffer = eventstream.EventStreamBuffer()
+    buffer.add_data(data)
+    messages = list(buffer)
+    assert len(messages) == len(decode_events(data))
+    assert all(message.headers[':event-type'] == 'chunk' for message in messages)
@@ -0,0 +1,89 @@
+from decimal import Decimal
+
+import pytest
+
+import src.submission.tools.formatting as formatting
+from src.submission.tools.formatting import format_result, format_value
+
+
+@pytest.fixture(autouse=True)
+def whitespace_tokenizer(monkeypatch):
+    # deterministic stand-in for the model tokenizer
+    monkeypatch.setattr(formatting, '_get_tokenizer', lambda: lambda text: len(text.split()))
+
+
+def test_format_value():
+    assert format_value(None) == ''
+    assert format_value(Decimal('549.123456')) == '549.12'
+    assert format_value(Decimal('0.001234')) == '0.00123'
+    assert format_value(2.0) == '2'
+    assert format_value(True) == 'True'
+    assert format_value('a\tb\nc') == 'a b c'
+
+
+def test_header_and_rows():
+    assert format_result(['country', 'score'], [('Poland', Decimal('549.1')), ('Spain', 521)]) == (
+        'country\tscore\nPoland\t549.1\nSpain\t521'
+    )
+
+
+def test_no_rows():
+    assert format_result(['a'], []) == 'a\n(no rows)'
+
+
+def test_constant_column_is_lifted_out():
+    ret = format_result(['country', 'year'], [('Poland', 2021), ('Spain', 2021)])
+    assert ret == 'constant: year=2021\ncountry\nPoland\nSpain'
+
+
+def test_legend_only_when_ditto_is_used():
+    ret = format_result(['code', 'answer'], [('A1', 'Yes'), ('A1', 'No'), ('A2', 'Yes')])
+    assert ret.splitlines() == ['(" = same as row above)', 'code\tanswer', 'A1\tYes', '"\tNo', 'A2\tYes']
+    assert 'same as row above' not in format_result(['code', 'answer'], [('A1', 'Yes'), ('A2', 'No')])
+
+
+def test_markdown_legend_goes_before_the_table():
+    ret = format_result(['code', 'n'], [('A1', 1), ('A1', 2), ('A2', 3)], fmt='markdown')
+    assert ret.splitlines() == [
+        '(" = same as row above)', '| code | n |', '| --- | --- |', '| A1 | 1 |', '| " | 2 |', '| A2 | 3 |'
+    ]
+
+
+def test_markdown_escapes_pipes():
+    ret = format_result(['a', 'b'], [('a|b', 1), ('c', 2)], fmt='markdown')
+    assert '| a\\|b | 1 |' in ret.splitlines()
+
+
+def test_none_only_rows_are_visible():
+    assert format_result(['a'], [(None,), (None,)]) == 'a\nNULL\nNULL'
+    assert format_result(['a', 'b'], [(None, 1), (None, 2)]) == 'constant: a=NULL\nb\n1\n2'
+
+
+def test_empty_strings_are_visible():
+    assert format_result(['a'], [('',), ('',)]) == 'a\nNULL\nNULL'
+    assert format_result(['a', 'b'], [('', 1), ('', 2)]) == 'constant: a=NULL\nb\n1\n2'
+
+
+def test_truncation_respects_the_budget_and_summarizes_dropped_rows():
+    rows = [(f'Country {i}', i) for i in range(100)]
+    ret = format_result(['country', 'score'], rows, max_tokens=40)
+    assert formatting.count_tokens(ret) <= 40
+    n_kept = len([line for line in ret.splitlines() if line.startswith('Country')])
+    assert 0 < n_kept < 100
+    assert f'... {100 - n_kept} more rows omitted (100 rows in total).' in ret
+    assert f'score: min={n_kept}, max=99' in ret
+
+
+def test_first_row_is_always_kept():
+    ret = format_result(['text'], [('a ' * 50,), ('b',)], max_tokens=5)
+    assert ret.splitlines()[1].startswith('a a')
+
+
+def test_rows_are_counted_once(monkeypatch):
+    counted = []
+    monkeypatch.setattr(formatting, '_get_tokenizer', lambda: lambda text: counted.append(text) or len(text.split()))
+    rows = [(f'Country {i}', i) for i in range(1000)]
+    format_result(['country', 'score'], rows, max_tokens=200)
+    # one count per row plus a logarithmic number of summaries, never the whole rendered table
+    assert len(counted) < 1000 + 30
+    assert all(text.count('\n') < 5 for text in counted)
@@ -0,0 +1,167 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import yaml
+
+from src.static import fake_bedrock
+from src.static.rate_limiter import (
+    BACKGROUND, INTERACTIVE, call_with_retries, get_rate_limiter, is_throttling_error, load_rate_limits,
+    stream_with_retries
+)
+
+FAST_MODEL = 'test.fast-v1'
+ORDERED_MODEL = 'test.ordered-v1'
+HAIKU = 'anthropic.claude-3-haiku-20240307-v1:0'
+
+
+@pytest.fixture
+def endpoint():
+    # 10 calls per second with a burst of 5, far below the limits the rate limiter starts with
+    server, stats = fake_bedrock.serve(port=0, requests_per_minute=600, latency=0.01, burst=5)
+    yield f'http://localhost:{server.server_address[1]}', stats
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def rate_limits(tmp_path, monkeypatch):
+    path = tmp_path / 'rate_limits.yaml'
+    path.write_text(yaml.safe_dump({
+        FAST_MODEL: {'requests_per_minute': 3_000, 'tokens_per_minute': 1_000_000, 'max_concurrency': 16},
+        ORDERED_MODEL: {'requests_per_minute': 3_000, 'tokens_per_minute': 1_000_000, 'max_concurrency': 1},
+        HAIKU: {'requests_per_minute': 1_200, 'max_concurrency': 4},
+        'default': {'max_concurrency': 2}
+    }))
+    monkeypatch.setenv('RATE_LIMITS_PATH', str(path))
+
+
+def invoke(url: str, model_id: str) -> str:
+    body = json.dumps({'messages': [{'role': 'user', 'content': 'question'}]}).encode()
+    request = urllib.request.Request(f'{url}/model/{model_id}/invoke', body, {'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())['content'][0]['text']
+    except urllib.error.HTTPError as e:
+        # the way langchain_aws reports errors of the Bedrock client
+        raise ValueError(f"Error raised by bedrock service: {e.headers.get('x-amzn-ErrorType')}: {e.read()}")
+
+
+def test_load_rate_limits():
+    limits, fallback = load_rate_limits()
+    assert limits[FAST_MODEL]['requests_per_minute'] == 3_000
+    assert fallback == {'requests_per_minute': 50, 'tokens_per_minute': 200_000, 'max_concurrency': 2}
+    assert limits[HAIKU] == {'requests_per_minute': 1_200, 'tokens_per_minute': 2_000_000, 'max_concurrency': 4}
+    assert limits['anthropic.claude-3-5-sonnet-20240620-v1:0']['requests_per_minute'] == 50
+
+
+def test_botocore_throttling_error_is_detected():
+    exceptions = pytest.importorskip('botocore.exceptions')
+    e = exceptions.ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Too many requests'}}, 'InvokeModel')
+    assert is_throttling_error(e)
+    # langchain_aws wraps the client errors
+    assert is_throttling_error(ValueError(f'Error raised by bedrock service: {e}'))
+    other = exceptions.ClientError({'Error': {'Code': 'ValidationException', 'Message': 'Bad input'}}, 'InvokeModel')
+    assert not is_throttling_error(other)
+
+
+def test_throttled_calls_are_retried_and_slow_down(endpoint):
+    url, stats = endpoint
+    calls = 60
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        results = list(executor.map(
+            lambda _: call_with_retries(FAST_MODEL, 10, lambda: invoke(url, FAST_MODEL), max_retries=20, base_delay=0.05, max_delay=0.5),
+            range(calls)
+        ))
+    limiter = get_rate_limiter(FAST_MODEL)
+    assert results == [fake_bedrock.DEFAULT_REPLY] * calls
+    assert stats['served'] == calls
+    assert stats['throttled'] > 0
+    assert limiter.metrics()['throttled'] == stats['throttled']
+    assert limiter.rate_factor < 1
+
+
+def test_throttled_stream_is_retried_before_the_first_chunk(endpoint):
+    url, stats = endpoint
+    for _ in range(10):
+        # drain the burst of the fake endpoint
+        try:
+            invoke(url, 'test.other-v1')
+        except ValueError:
+            break
+
+    def open_stream():
+        yield from invoke(url, 'test.stream-v1').split()
+
+    chunks = list(stream_with_retries('test.stream-v1', 10, open_stream, max_retries=20, base_delay=0.05, max_delay=0.5))
+    assert ' '.join(chunks) == fake_bedrock.DEFAULT_REPLY.replace('\n', ' ')
+    assert get_rate_limiter('test.stream-v1').metrics()['in_flight'] == 0
+
+
+def test_interactive_calls_are_served_first(endpoint):
+    url, _ = endpoint
+    order = []
+    blocking = threading.Event()
+
+    def call(priority: int):
+        def fn():
+            order.append(priority)
+            blocking.wait()
+            return invoke(url, ORDERED_MODEL)
+        return call_with_retries(ORDERED_MODEL, 10, fn, priority=priority, max_retries=20, base_delay=0.05, max_delay=0.5)
+
+    with ThreadPoolExecutor(max_workers=9) as executor:
+        # the first call holds the only slot while the others queue up, background calls arriving first
+        futures = [executor.submit(call, BACKGROUND)]
+        time.sleep(0.1)
+        futures += [executor.submit(call, BACKGROUND) for _ in range(4)]
+        time.sleep(0.1)
+        futures += [executor.submit(call, INTERACTIVE) for _ in range(4)]
+        time.sleep(0.1)
+        blocking.set()
+        results = [future.result() for future in futures]
+
+    assert results == [fake_bedrock.DEFAULT_REPLY] * 9
+    # retries of throttled calls are appended as well, so only the calls served first are compared
+    assert order[:6] == [BACKGROUND, INTERACTIVE, INTERACTIVE, INTERACTIVE, INTERACTIVE, BACKGROUND]
+
+
+def test_chat_bedrock_wrapper_against_the_fake_endpoint(endpoint, monkeypatch):
+    pytest.importorskip('langchain_aws')
+    from botocore.config import Config
+    from src.static.ChatBedrockWrapper import TOKEN_COUNTER, ChatBedrockWrapper
+
+    url, stats = endpoint
+    for key in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']:
+        monkeypatch.setenv(key, 'fake')
+    llm = ChatBedrockWrapper(
+        model_id=HAIKU,
+        call_id='test_fake_endpoint',
+        region_name='us-east-1',
+        endpoint_url=url,
+        # the same botocore config as the router: throttled calls are retried by the rate limiter only
+        config=Config(retries={'total_max_attempts': 1}),
+        model_kwargs={'temperature': 0}
+    )
+
+    def call(i: int) -> str:
+        # crew agents stream their calls, chains invoke
+        if i % 2:
+            return ''.join(chunk.content for chunk in llm.stream('question'))
+        return llm.invoke('question').content
+
+    calls = 12
+    with ThreadPoolExecutor(max_workers=calls) as executor:
+        results = list(executor.map(call, range(calls)))
+
+    assert results == [fake_bedrock.DEFAULT_REPLY] * calls
+    assert stats['served'] == calls
+    assert stats['throttled'] > 0
+    assert get_rate_limiter(HAIKU).metrics()['throttled'] == stats['throttled']
+    # every call is counted once, whether invoked or streamed
+    assert TOKEN_COUNTER['test_fake_endpoint'][HAIKU]['successful_requests'] == calls
+    assert TOKEN_COUNTER['test_fake_endpoint'][HAIKU]['completion_tokens'] > 0